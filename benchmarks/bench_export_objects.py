@@ -0,0 +1,227 @@
+'''
+Scaling of the candidate, handle and exported-name bookkeeping of
+export_objects on a stand-in scene: dupli parents whose instances reference
+a pool of source objects.
+
+The new version is export_objects itself, compiled from export.py with the
+functions that write geometry, transforms and comments replaced by no-ops
+and an Ri binding whose calls do nothing. get_duplis answers from arrays
+built up front, as the dupli cache does once an object has been reviewed.
+The old version reproduces the bookkeeping export_objects had around the
+instance masters and instances, with lists, uniquifyList and
+returnHandleForName. Object lookups go through a stand-in of
+bpy.data.objects whose get() is a linear search by name, as Blender's is.
+
+    python benchmarks/bench_export_objects.py [--sizes 1e3,1e4,1e5,1e6]
+
+The time per instance of the list version grows with the number of
+sources, that of export_objects stays within a small constant factor from
+1k to 1M instances (memory effects, not lookups). Both are checked to
+export the same instance names.
+'''
+
+import argparse
+import types
+from collections import OrderedDict
+import numpy as np
+
+from common import best_time, load_functions, parse_sizes
+
+
+class StandInData:
+    def __init__(self, name):
+        self.name = name
+        self.polygons = [None]
+        self.materials = []
+
+
+class StandInObject:
+    def __init__(self, name, data_name, type='MESH'):
+        self.name = name
+        self.type = type
+        self.data = StandInData(data_name)
+        self.dupli_type = 'NONE'
+        self.dupli_object = None
+        self.particle_systems = []
+        self.parent = None
+
+
+class StandInObjects:
+    '''bpy.data.objects, get() searches the names in order'''
+    def __init__(self, obs):
+        self.obs = obs
+
+    def get(self, name):
+        for ob in self.obs:
+            if ob.name == name:
+                return ob
+        return None
+
+
+class StandInRi:
+    '''an Ri binding whose calls do nothing, ObjectBegin counts handles'''
+    def __init__(self):
+        self.handles = 0
+
+    def ObjectBegin(self):
+        self.handles += 1
+        return self.handles
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class StandInScene:
+    '''ninstances duplis over a pool of sources, ten dupli parents'''
+    def __init__(self, ninstances):
+        nsources = max(10, ninstances // 100)
+        # sources pair up on datablocks, as duplicated objects do
+        self.sources = [StandInObject('source.%06d' % i, 'mesh.%06d' % (i // 2))
+                        for i in range(nsources)]
+        # empties duplicating objects, reviewed once each
+        self.parents = []
+        for i in range(10):
+            parent = StandInObject('parent.%d' % i, None, 'EMPTY')
+            parent.dupli_type = 'OBJECT'
+            parent.dupli_object = self.sources[i]
+            self.parents.append(parent)
+        self.objects = StandInObjects(self.sources + self.parents)
+        self.renderman = types.SimpleNamespace(auto_instancing=False,
+                                               deduplicate_geometry=False)
+
+        # (parent, source object position, dupli index) of every instance
+        self.instances = [(i % 10, (i * 7919) % nsources, i)
+                          for i in range(ninstances)]
+        # the dupli cache entry of each parent, as get_duplis returns them
+        self.duplis = {}
+        for p, parent in enumerate(self.parents):
+            instances = self.instances[p::10]
+            positions = {}
+            sources = []
+            for parent_index, source, index in instances:
+                if source not in positions:
+                    positions[source] = len(sources)
+                    sources.append(self.sources[source])
+            self.duplis[parent.name] = {
+                'matrices': np.zeros((len(instances), 16)),
+                'hide': np.zeros(len(instances), dtype=bool),
+                'index': np.array([index for parent_index, source, index
+                                   in instances], dtype=np.int32),
+                'source': np.array([positions[source] for parent_index,
+                                    source, index in instances],
+                                   dtype=np.int32),
+                'sources': sources}
+
+
+def stand_in_export(scene):
+    '''the names export_objects depends on, exported names are recorded'''
+    exported = []
+    def exportObjectInstance(ri, rpass, scene, ob, mtx=None, dupli_name=None,
+                             instance_handle=None):
+        exported.append(dupli_name)
+    def nothing(*args, **kwargs):
+        return None
+
+    bpy = types.SimpleNamespace(data=types.SimpleNamespace(
+        objects=scene.objects, groups=StandInObjects([])))
+    namespace = {
+        'OrderedDict': OrderedDict, 'np': np, 'bpy': bpy,
+        'debug': nothing,
+        'get_scene_index': lambda scene: {'renderable': scene.parents,
+                                          'dupli_children': set()},
+        'get_duplis': lambda scene, ob: scene.duplis[ob.name],
+        'get_shared_data': lambda obs, motion: {},
+        'get_shared_geometry': lambda scene, obs, motion: {},
+        'exportObjectInstance': exportObjectInstance,
+        'returnMatrixForObject': nothing}
+    for name in ('detect_primitive', 'exportObjectArchive', 'export_curve',
+                 'export_geometry', 'export_light', 'export_object',
+                 'export_primitive', 'export_strands'):
+        namespace[name] = nothing
+    return namespace, exported
+
+
+def bookkeeping_lists(scene, uniquifyList, returnNameForNumber):
+    candidate_duplis = []
+    candidate_instance_sources = []
+    candidate_instance_handles = []
+    exported_objects = []
+
+    def returnHandleForName(passed_list, passed_name):
+        for name, handle in passed_list:
+            if name == passed_name:
+                return handle
+        return None
+
+    for parent in scene.parents:
+        candidate_instance_sources.append(parent.dupli_object.name)
+
+    for p, source, index in scene.instances:
+        ob = scene.sources[source]
+        dupli_name = "%s_%s_p%s" % (scene.parents[p].name,
+            ("%s~%s" % ("", ob.name)), returnNameForNumber(index))
+        candidate_duplis.append((ob.name, ob.type, None, dupli_name))
+
+    for ob_name, ob_type, m, dupli_name in candidate_duplis:
+        if scene.objects.get(ob_name) != None:
+            candidate_instance_sources.append(ob_name)
+
+    for candidate in uniquifyList(candidate_instance_sources):
+        ob_temp = scene.objects.get(candidate)
+        handle_name = ob_temp.data.name
+        if returnHandleForName(candidate_instance_handles, handle_name) == None:
+            candidate_instance_handles.append((handle_name,
+                len(candidate_instance_handles)))
+
+    for ob_name, ob_type, m, dupli_name in candidate_duplis:
+        ob_temp = scene.objects.get(ob_name)
+        if ob_temp != None and len(ob_temp.data.polygons) > 0:
+            instance_handle = returnHandleForName(candidate_instance_handles,
+                                                  ob_temp.data.name)
+            if instance_handle != None:
+                exported_objects.append(dupli_name)
+
+    return exported_objects
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=parse_sizes,
+                        default=parse_sizes('1e3,1e4,1e5,1e6'),
+                        help='comma separated instance counts')
+    parser.add_argument('--old-max', type=int, default=10 ** 4,
+                        help='largest scene to run the list version on, it '
+                             'is quadratic and takes minutes past 100k')
+    args = parser.parse_args()
+
+    print("%10s %8s %12s %12s %16s" %
+          ('instances', 'sources', 'lists s', 'export s', 'export us/inst'))
+    for size in args.sizes:
+        scene = StandInScene(size)
+        namespace, exported = stand_in_export(scene)
+        export = load_functions('export.py',
+            ['export_objects', 'export_comment', 'printList', 'uniquifyList',
+             'returnNameForNumber', 'GLOBAL_ZERO_PADDING',
+             'SUPPORTED_INSTANCE_TYPES', 'SUPPORTED_DUPLI_TYPES'], namespace)
+        export_objects = export['export_objects']
+        uniquifyList = export['uniquifyList']
+        returnNameForNumber = export['returnNameForNumber']
+
+        new = best_time(export_objects, (StandInRi(), None, scene, None))
+        if size <= args.old_max:
+            old = best_time(bookkeeping_lists,
+                            (scene, uniquifyList, returnNameForNumber), 1)
+            del exported[:]
+            export_objects(StandInRi(), None, scene, None)
+            assert sorted(bookkeeping_lists(scene, uniquifyList,
+                                            returnNameForNumber)) == \
+                sorted(exported)
+            old = "%12.4f" % old
+        else:
+            old = "%12s" % '-'
+        print("%10d %8d %s %12.4f %16.3f" % (size, len(scene.sources), old,
+                                            new, new / size * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+'''
+Compares the gen_params the exporter used to have, which formatted the Ri
+keys and branched on the parameter metadata for every node exported, with
+the one in nodes.py, which loops over the prop_emitter tuples built once
+per node class by class_generate_properties.
+
+The node classes are generated from .args files by the real
+class_generate_properties and param_emitter, with a stand-in bpy.props
+whose properties only keep their default. Node instances hold those
+defaults, arrays as a stand-in bpy_prop_array, and every third parameter
+is linked to another node.
+
+    python benchmarks/bench_gen_params.py [--args-path DIR] [--sizes 1e3,1e4,1e5]
+
+The .args files are read from $RMANTREE/lib/RIS when it is set, and from
+the shaders/Args directory of the add-on otherwise. Both versions are
+checked to return the same parameters for every node class.
+'''
+
+import argparse
+import os
+import sys
+import types
+import xml.etree.ElementTree as ET
+import numpy as np
+
+from common import best_time, load_functions, package_dir, parse_sizes
+
+
+class StandInProperty:
+    '''a bpy.props property, keeps the default value'''
+    def __init__(self, **kwargs):
+        self.default = kwargs.get('default')
+
+
+class StandInEnumProperty(StandInProperty):
+    def __init__(self, **kwargs):
+        self.default = kwargs.get('default', kwargs['items'][0][0]
+                                  if kwargs.get('items') else '')
+
+
+class bpy_prop_array(tuple):
+    '''vector properties, rib() recognises them by class name'''
+
+
+class StandInVectorProperty(StandInProperty):
+    def __init__(self, **kwargs):
+        self.default = bpy_prop_array(kwargs.get('default'))
+
+
+props = types.SimpleNamespace(
+    BoolProperty=StandInProperty,
+    EnumProperty=StandInEnumProperty,
+    FloatProperty=StandInProperty,
+    FloatVectorProperty=StandInVectorProperty,
+    IntProperty=StandInProperty,
+    IntVectorProperty=StandInVectorProperty,
+    StringProperty=StandInProperty)
+
+# rib() tests for these types before falling back on the type hint
+mathutils = types.SimpleNamespace(Vector=type('Vector', (), {}),
+                                  Color=type('Color', (), {}),
+                                  Matrix=type('Matrix', (), {}))
+
+
+# an instance of a generated node class, every property at its default
+def stand_in_node(node_class):
+    node = node_class()
+    for name, meta in node_class.prop_meta.items():
+        if meta['renderman_type'] != 'page':
+            setattr(node, name, getattr(node_class, name).default)
+    return node
+
+
+def args_files(path):
+    for root, dirs, files in os.walk(path):
+        for f in sorted(files):
+            if os.path.splitext(f)[1] == '.args':
+                yield os.path.join(root, f)
+
+
+def generate_node_class(path, class_generate_properties):
+    args = ET.parse(path).getroot()
+    name = os.path.splitext(os.path.basename(path))[0]
+    node_class = type(name, (), {})
+    inputs = args.findall('./param') + args.findall('./page')
+    class_generate_properties(node_class, name, inputs)
+    return node_class
+
+
+# gen_params as it was before the node classes had prop_emitter
+def gen_params_per_export(ri, node, links, rib, get_tex_file_name):
+    params = {}
+    for prop_name,meta in node.prop_meta.items():
+        #if property group recurse
+        if meta['renderman_type'] == 'page':
+            continue
+        #if input socket is linked reference that
+        elif prop_name in links:
+            params['reference %s %s' % (meta['renderman_type'],
+                    meta['renderman_name'])] = [links[prop_name]]
+        #else output rib
+        else:
+            prop = getattr(node, prop_name)
+            if 'options' in meta and meta['options'] == 'texture':
+                params['%s %s' % (meta['renderman_type'],
+                        meta['renderman_name'])] = \
+                    rib(get_tex_file_name(prop),
+                        type_hint=meta['renderman_type'])
+            elif 'arraySize' in meta:
+                params['%s[%d] %s' % (meta['renderman_type'], len(prop),
+                        meta['renderman_name'])] = rib(prop)
+            else:
+                params['%s %s' % (meta['renderman_type'],
+                        meta['renderman_name'])] = \
+                    rib(prop, type_hint=meta['renderman_type'])
+
+    return params
+
+
+def main():
+    rmantree = os.environ.get('RMANTREE')
+    default_path = os.path.join(rmantree, 'lib', 'RIS') if rmantree else \
+        os.path.join(package_dir, 'shaders', 'Args')
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--args-path', default=default_path,
+                        help='directory searched for .args files')
+    parser.add_argument('--sizes', type=parse_sizes,
+                        default=parse_sizes('1e3,1e4,1e5'),
+                        help='comma separated numbers of nodes exported')
+    args = parser.parse_args()
+
+    bpy = types.SimpleNamespace(props=props)
+    shader_parameters = load_functions('shader_parameters.py',
+        ['get_tex_file_name', 'sp_optionmenu_to_string', 'parse_float',
+         'rib_texture_param', 'rib_value_param', 'param_converter',
+         'param_emitter', 'class_generate_properties', 'generate_property'],
+        {'bpy': bpy, 'os': os, 'sys': sys})
+    rib = load_functions('util.py', ['rib'],
+                         {'np': np, 'mathutils': mathutils})['rib']
+    gen_params = load_functions('nodes.py', ['gen_params'], {})['gen_params']
+    get_tex_file_name = shader_parameters['get_tex_file_name']
+
+    paths = list(args_files(args.args_path))
+    if not paths:
+        parser.error("no .args files in %s" % args.args_path)
+    nodes = []
+    for path in paths:
+        node = stand_in_node(generate_node_class(path,
+            shader_parameters['class_generate_properties']))
+        links = dict((prop_name, 'upstream_%d:resultRGB' % i)
+                     for i, (prop_name, key, reference_key, convert)
+                     in enumerate(node.prop_emitter) if i % 3 == 2)
+        assert gen_params(None, node, links) == \
+            gen_params_per_export(None, node, links, rib, get_tex_file_name)
+        nodes.append((node, links))
+    nparams = sum(len(node.prop_emitter) for node, links in nodes)
+    print("%d node classes from %s, %.1f parameters per node" %
+          (len(nodes), args.args_path, nparams / len(nodes)))
+
+    def export_old(exports):
+        for node, links in exports:
+            gen_params_per_export(None, node, links, rib, get_tex_file_name)
+
+    def export_new(exports):
+        for node, links in exports:
+            gen_params(None, node, links)
+
+    print("%10s %12s %12s %10s" % ('nodes', 'old s', 'new s', 'speedup'))
+    for size in args.sizes:
+        exports = [nodes[i % len(nodes)] for i in range(size)]
+        old = best_time(export_old, (exports,))
+        new = best_time(export_new, (exports,))
+        print("%10d %12.4f %12.4f %9.1fx" % (size, old, new, old / new))
+
+
+if __name__ == '__main__':
+    main()
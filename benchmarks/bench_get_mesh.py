@@ -0,0 +1,142 @@
+'''
+Compares the per-element get_mesh the exporter used to have with the
+foreach_get based one in export.py, on a stand-in mesh: a grid of quads
+whose collections answer foreach_get with a copy of a numpy array, and
+yield a small Python object per element when iterated.
+
+The stand-in measures the Python side of both versions. Real RNA element
+access is slower than these objects and real foreach_get is slower than a
+memcpy, so the speedup in Blender differs, but the scaling is the same.
+
+    python benchmarks/bench_get_mesh.py [--sizes 10e3,1e6,10e6] [--old-max N]
+
+Both versions are checked to return the same lists where the old one runs.
+'''
+
+import argparse
+import math
+import numpy as np
+
+from common import best_time, load_functions, parse_sizes
+
+
+class StandInItem:
+    __slots__ = ('collection', 'index')
+
+    def __init__(self, collection, index):
+        self.collection = collection
+        self.index = index
+
+    def __getattr__(self, attr):
+        return self.collection.item_attr(attr, self.index)
+
+
+class StandInCollection:
+    '''a bpy_prop_collection over flat arrays, one per attribute'''
+    def __init__(self, length, arrays, item_attrs={}):
+        self.length = length
+        self.arrays = arrays
+        self.item_attrs = item_attrs
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for i in range(self.length):
+            yield StandInItem(self, i)
+
+    def foreach_get(self, attr, values):
+        values[:] = self.arrays[attr]
+
+    def item_attr(self, attr, index):
+        if attr in self.item_attrs:
+            return self.item_attrs[attr](index)
+        array = self.arrays[attr]
+        size = len(array) // self.length
+        if size == 1:
+            return array[index].item()
+        return tuple(array[index * size:(index + 1) * size].tolist())
+
+
+class StandInMesh:
+    '''a grid of quads with about nverts vertices'''
+    def __init__(self, nverts):
+        side = max(2, int(math.sqrt(nverts)))
+        x, y = np.meshgrid(np.arange(side, dtype=np.float32),
+                           np.arange(side, dtype=np.float32))
+        co = np.stack([x.ravel(), y.ravel(), np.zeros(side * side,
+                        dtype=np.float32)], axis=1).ravel()
+
+        corner = (np.arange(side - 1)[None, :] +
+                  side * np.arange(side - 1)[:, None]).ravel()
+        vertex_index = np.stack([corner, corner + 1, corner + side + 1,
+                                 corner + side], axis=1).ravel()
+        npolys = len(corner)
+        loop_total = np.full(npolys, 4, dtype=np.int32)
+        loop_start = np.arange(npolys, dtype=np.int32) * 4
+
+        self.vertices = StandInCollection(side * side, {'co': co})
+        self.loops = StandInCollection(len(vertex_index),
+                        {'vertex_index': vertex_index.astype(np.int32)})
+        self.polygons = StandInCollection(npolys,
+            {'loop_total': loop_total, 'loop_start': loop_start},
+            {'vertices': lambda i:
+                tuple(vertex_index[i * 4:i * 4 + 4].tolist())})
+
+
+# get_mesh as it was before it used foreach_get
+def get_mesh_per_element(mesh):
+    nverts = []
+    verts = []
+    P = []
+
+    for v in mesh.vertices:
+        P.extend( v.co )
+
+    for p in mesh.polygons:
+        nverts.append( p.loop_total )
+        verts.extend( p.vertices )
+
+    return (nverts, verts, P)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=parse_sizes,
+                        default=parse_sizes('10e3,1e6,10e6'),
+                        help='comma separated vertex counts')
+    parser.add_argument('--old-max', type=int, default=10 ** 6,
+                        help='largest mesh to run the old version on, '
+                             'it takes about a minute for 10M vertices')
+    args = parser.parse_args()
+
+    export = load_functions('export.py', ['foreach_array', 'get_mesh'],
+                            {'np': np})
+    get_mesh = export['get_mesh']
+
+    # the Ri binding takes lists, the new arrays are converted when written
+    def get_mesh_for_ri(mesh):
+        return [a.tolist() for a in get_mesh(mesh)]
+
+    print("%12s %12s %12s %12s %10s" %
+          ('vertices', 'old s', 'new s', 'new+list s', 'speedup'))
+    for size in args.sizes:
+        mesh = StandInMesh(size)
+        nverts = len(mesh.vertices)
+
+        new = best_time(get_mesh, (mesh,))
+        new_list = best_time(get_mesh_for_ri, (mesh,))
+        if nverts <= args.old_max:
+            old = best_time(get_mesh_per_element, (mesh,), repeat=1)
+            assert get_mesh_for_ri(mesh) == \
+                [list(map(float, a)) if i == 2 else a
+                 for i, a in enumerate(get_mesh_per_element(mesh))]
+            print("%12d %12.4f %12.4f %12.4f %9.1fx" %
+                  (nverts, old, new, new_list, old / new_list))
+        else:
+            print("%12d %12s %12.4f %12.4f %10s" %
+                  (nverts, '-', new, new_list, '-'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+# Helpers shared by the benchmark scripts, which run outside of Blender.
+#
+# The add-on modules import bpy at the top, so the functions being measured
+# are compiled straight from their source instead of importing the module.
+
+import ast
+import os
+import time
+
+package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def defined_name(node):
+    if isinstance(node, ast.FunctionDef):
+        return node.name
+    if isinstance(node, ast.Assign) and len(node.targets) == 1 and \
+            isinstance(node.targets[0], ast.Name):
+        return node.targets[0].id
+    return None
+
+# compile the named top level functions and constants 
+# of an add-on module into namespace
+def load_functions(module, names, namespace):
+    path = os.path.join(package_dir, module)
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+    body = [node for node in tree.body if defined_name(node) in names]
+    missing = set(names) - set(defined_name(node) for node in body)
+    if missing:
+        raise NameError("%s not found in %s" % (', '.join(missing), module))
+    code = ast.Module(body=body)
+    code.type_ignores = []
+    exec(compile(code, path, 'exec'), namespace)
+    return namespace
+
+# best wall time of a few runs of func(*args)
+def best_time(func, args=(), repeat=3):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def parse_sizes(text):
+    return [int(float(s)) for s in text.split(',')]
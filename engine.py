@@ -54,6 +54,7 @@ addon_version = bl_info['version']
 
 # global dictionaries
 from .export import write_rib, write_preview_rib, get_texture_list
+from .export import begin_scene_index, end_scene_index
 from .export import get_texture_list_preview
 
 #set pythonpath
@@ -286,8 +287,13 @@ class RPass:
         pass
 
     def gen_rib(self):
-        self.convert_textures(get_texture_list(self.scene))
-        write_rib(self, self.scene, self.ri)
+        # the scene is scanned once for both textures and objects
+        begin_scene_index(self.scene)
+        try:
+            self.convert_textures(get_texture_list(self.scene))
+            write_rib(self, self.scene, self.ri)
+        finally:
+            end_scene_index()
 
     def gen_preview_rib(self):
         self.convert_textures(get_texture_list_preview(self.scene))
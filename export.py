@@ -27,11 +27,14 @@ import bpy
 import math, mathutils
 import os
 import time
-from mathutils import Matrix, Vector, Quaternion
+import hashlib
+from collections import OrderedDict
+import numpy as np
+from mathutils import Matrix, Vector
 
 from . import bl_info
 
-from .util import rib, rib_path, rib_ob_bounds
+from .util import rib, rib_params, rib_path, rib_ob_bounds
 from .util import make_frame_path
 from .util import init_env
 from .util import get_sequence_path
@@ -62,8 +65,6 @@ PSYS_PREFIX = "psys_"
 DUPLI_PREFIX = "dupli_"
 DUPLI_SOURCE_PREFIX = "dup_src_"
 
-def rounded_tuple(tup):
-    return tuple(round(value,4) for value in tup) 
 def returnNameForNumber(passedInteger):
     temp_number = str(passedInteger)
     post_fix = temp_number.zfill(GLOBAL_ZERO_PADDING)
@@ -98,7 +99,7 @@ def exportObjectInstance(ri, rpass, scene, ob, mtx = None, dupli_name = None, in
         ri.Transform(rib(mtx))
         if ob.data and ob.data.materials:
             for mat in [mat for mat in ob.data.materials if mat != None]:
-                export_material(ri, rpass, scene, mat)
+                bind_material(ri, rpass, scene, mat)
         ri.ObjectInstance(instance_handle)
         ri.TransformEnd()
         ri.AttributeEnd()
@@ -110,9 +111,9 @@ def exportObjectArchive(ri, rpass, scene, ob, mtx = None, object_name = None, in
         ri.Transform(rib(mtx))
         if ob.data and ob.data.materials:
             for mat in [mat for mat in ob.data.materials if mat != None]:
-                export_material(ri, rpass, scene, mat)
+                bind_material(ri, rpass, scene, mat)
             if instance_handle == object_name + "HAIR":
-                export_material(ri, rpass, scene, ob.data.materials[matNum])
+                bind_material(ri, rpass, scene, ob.data.materials[matNum])
         ri.ReadArchive(instance_handle)
         ri.TransformEnd()
         ri.AttributeEnd()
@@ -168,49 +169,6 @@ def removeObjectFromMemory (passedName):
         # We could not fetch it, it does not exist in memory, essentially removed.
         result = True
     return result 
-def returnNewMeshFromFaces(passedNewName, passedMesh, passedMaterialIndex = -1):
-    # Take the passed mesh and make a new mesh that is made up of only with the vertices that the faces require.
-    # You can optionaly include only faces for a specific material index.
-    # (i.e. remove unused vertices.)
-    me_result = None    
-    if passedMesh != None:
-        #to_console("returnNewMeshFromFaces: create a mesh made up of faces with material " + str(passedMaterialIndex))
-        #Get the material based upon the passedMaterialIndex.
-        if passedMaterialIndex == -1:
-            # Default to the first one.
-            mat = passedMesh.materials[0]
-        else:
-            # User specified another material.
-            mat = passedMesh.materials[passedMaterialIndex]
-        if mat != None:
-            vert_list = []
-            face_list =[]
-            c = 0
-            for face in passedMesh.polygons:
-                can_proceed = False
-                if passedMaterialIndex == -1: can_proceed = True
-                if face.material_index == passedMaterialIndex: can_proceed = True
-                if can_proceed == True:
-                    x = []
-                    for vert in face.vertices:
-                        vertex = passedMesh.vertices[vert]
-                        vert_list.append(rounded_tuple(vertex.co.to_tuple()))
-                        x.append(c)
-                        c =c + 1
-                    face_list.append(x)
-            
-            if len(face_list) > 0:
-                me_result = bpy.data.meshes.new(passedNewName)       # Create a new blank mesh.
-                try:
-                    me_result.from_pydata(vert_list,[],face_list)    # Give this empty mesh a list of verts and faces to call it's own.
-                    me_result.update(calc_edges=True)
-                    me_result.materials.append(mat)
-                except:
-                    me_result = None
-    return me_result
-
-
-
 # ------------- Texture optimisation -------------
 
 # 3Delight specific tdlmake stuff
@@ -312,7 +270,68 @@ def is_renderable(scene, ob):
     # and not ob.type in ('CAMERA', 'ARMATURE', 'LATTICE'))
 
 def renderable_objects(scene):
-    return [ob for ob in scene.objects if is_renderable(scene, ob)]
+    return get_scene_index(scene)['renderable']
+
+# ------------- Scene Index -------------
+# Everything the exporter asks about the objects of the scene, gathered in 
+# a single pass. An index is kept from begin_scene_index() until 
+# end_scene_index(), lookups outside of that build a temporary one.
+active_scene_index = None
+
+def layer_bitmask(layers):
+    return int(np.dot(np.asarray(layers, dtype=np.int64), 
+                    1 << np.arange(len(layers), dtype=np.int64)))
+
+def build_scene_index(scene):
+    objects = list(scene.objects)
+    
+    # layers and visibility of every object, read in bulk
+    layers = foreach_array(scene.objects, 'layers', 20, bool).reshape(-1, 20)
+    hide_render = foreach_array(scene.objects, 'hide_render', dtype=bool)
+    bitmasks = np.dot(layers.astype(np.int64), 1 << np.arange(20, dtype=np.int64))
+    visible = ((bitmasks & layer_bitmask(scene.layers)) != 0) & ~hide_render
+    
+    index = {
+        'scene': scene.name,
+        'renderable': [ob for ob, v in zip(objects, visible.tolist()) if v],
+        'renderable_names': set(),
+        'types': {},
+        'dupli_children': set(),
+        'materials': OrderedDict(),
+        'particle_systems': {},
+        }
+    
+    for ob in index['renderable']:
+        index['renderable_names'].add(ob.name)
+        index['types'].setdefault(ob.type, []).append(ob)
+        
+        # objects only rendered through the duplis of their parent
+        if ob.parent and ob.parent.dupli_type in SUPPORTED_DUPLI_TYPES:
+            index['dupli_children'].add(ob.name)
+        
+        for mat in get_instance_materials(ob):
+            if mat != None:
+                obs = index['materials'].setdefault(mat, [])
+                if not obs or obs[-1] != ob:
+                    obs.append(ob)
+        
+        if len(ob.particle_systems):
+            index['particle_systems'][ob.name] = list(ob.particle_systems)
+    
+    return index
+
+def begin_scene_index(scene):
+    global active_scene_index
+    active_scene_index = build_scene_index(scene)
+
+def end_scene_index():
+    global active_scene_index
+    active_scene_index = None
+
+def get_scene_index(scene):
+    if active_scene_index != None and active_scene_index['scene'] == scene.name:
+        return active_scene_index
+    return build_scene_index(scene)
 
 
 # ------------- Archive Helpers -------------
@@ -334,13 +353,15 @@ def auto_archive_path(paths, objects, create_folder=False):
 def archive_objects(scene):
     archive_obs = []
     
-    for ob in renderable_objects(scene):
+    index = get_scene_index(scene)
+    
+    for ob in index['renderable']:
         # explicitly set
         if ob.renderman.export_archive == True:
             archive_obs.append(ob)
         
         # particle instances
-        for psys in ob.particle_systems:
+        for psys in index['particle_systems'].get(ob.name, []):
             rm = psys.settings.renderman
             if rm.particle_type == 'OBJECT':
                 try:
@@ -412,128 +433,153 @@ def psys_motion_name(ob, psys):
 
 # ------------- Geometry Access -------------
 
-def get_strands(ri, scene,ob, psys):
-    tip_width = psys.settings.renderman.tip_width
-    base_width = psys.settings.renderman.base_width
-    conwidth = psys.settings.renderman.constant_width
+def get_strands(scene, ob, psys):
+    rm = psys.settings.renderman
     steps = 2 ** psys.settings.render_step 
-    if conwidth:
-        widthString = "constantwidth"
-        hair_width = psys.settings.renderman.width
-        debug("info",widthString, hair_width)
-    else:
-        widthString = "vertex float width"
-        #hair_width = [base_width]
-        hair_decriment = base_width / (steps)
-        
-    
-    
-    hair_length = psys.settings.hair_length
-    
-
     
     psys.set_resolution(scene, ob, 'RENDER')
     
-    
     num_parents = len(psys.particles)
     num_children = len(psys.child_particles)
-
-    
     total_hair_count = num_parents + num_children
-    thicknessflag = 0
-    width_offset = psys.settings.renderman.width_offset
-    
-    wmatx = ob.matrix_world.to_4x4().inverted()
     
-    
-    
-    ri.Basis("CatmullRomBasis", 1, "CatmullRomBasis", 1)
-    ri.Attribute("dice", {"int roundcurve": 1, "int hair": 1})
-    j = 0
+    # evaluate every hair point exactly once
+    co = []
     for pindex in range(total_hair_count):
-        points = []
-        hair_width = [base_width]
-        nverts = 0
-        i = 0
-        
         for step in range(0, steps + 1):
-            co = psys.co_hair(ob, pindex, step)
-            
-            if not co.length_squared == 0:
-                points.extend(wmatx * psys.co_hair(ob, pindex, step))
-                if i == 0 or i == steps:
-                    points.extend(wmatx * psys.co_hair(ob, pindex, step))
-                    nverts += 1
-            
-            if not conwidth :
-                if i == 0:
-                    hair_width.append(hair_width[0])
-                elif i == steps:
-                    hair_width.append(hair_width[i] - hair_decriment)
-                    hair_width.append(hair_width[i + 1])
-                else:
-                    hair_width.append(hair_width[i] - hair_decriment)
-            nverts += 1
-            i += 1
-        debug("info","Exporting ",j , "Strands and ", nverts ," Vertices")
-        debug("info", "WIDTH:",widthString,hair_width)
-        debug("info", "POINTS:",points)
-        
-        ri.Curves("cubic", [nverts], "nonperiodic", {"P": rib(points), widthString: hair_width})
-        j += 1
+            co.extend(psys.co_hair(ob, pindex, step))
+    co = np.array(co, dtype=np.float32).reshape(total_hair_count, steps + 1, 3)
+    
     psys.set_resolution(scene, ob, 'PREVIEW')
-
-# only export particles that are alive, 
-# or have been born since the last frame
-def valid_particle(pa, cfra):
-    return not (pa.birth_time > cfra or (pa.birth_time + pa.die_time) < cfra)
-
-def get_particles(scene, ob, psys):
-    P = []
-    rot = []
-    width = []
     
+    # zero length points mark the unused end of a strand, 
+    # the first and last points are doubled for the catmull-rom basis
+    step_repeats = np.ones(steps + 1, dtype=np.int32)
+    step_repeats[0] += 1
+    step_repeats[-1] += 1
+    repeats = np.any(co != 0.0, axis=2) * step_repeats
+    repeats[repeats.sum(axis=1) < 4] = 0
+    nverts = repeats.sum(axis=1)
+    nverts = nverts[nverts > 0]
+    
+    wmatx = np.array(ob.matrix_world.to_4x4().inverted(), dtype=np.float32)
+    co = co.reshape(-1, 3).dot(wmatx[:3, :3].T) + wmatx[:3, 3]
+    P = np.repeat(co, repeats.ravel(), axis=0).ravel()
+    
+    if rm.constant_width:
+        width = None
+    else:
+        # taper from base_width at the root down to zero at the tip
+        step_width = rm.base_width - np.arange(steps + 1) * \
+                        (rm.base_width / steps)
+        width = np.repeat(np.tile(step_width, total_hair_count), 
+                            repeats.ravel()).astype(np.float32)
+    
+    debug("info", "Exporting %d Strands and %d Vertices" % 
+        (len(nverts), len(P) // 3))
+    
+    return (nverts, P, width)
+
+# split strands into a number of similarly sized runs of strand indices
+def get_strand_batches(nverts, batches):
+    bounds = np.linspace(0, len(nverts), batches + 1).astype(np.int64)
+    return [np.arange(start, end) for start, end in zip(bounds[:-1], bounds[1:])
+            if start != end]
+
+# group strands by the cell of a regular grid their root falls into
+def get_strand_chunks(strands, grid):
+    nverts, P, width = strands
+    if len(nverts) == 0:
+        return []
+    
+    roots = P.reshape(-1, 3)[np.cumsum(nverts) - nverts]
+    lo = roots.min(axis=0)
+    size = np.maximum(roots.max(axis=0) - lo, 1e-6)
+    cell = np.minimum((roots - lo) / size * grid, grid - 1).astype(np.int64)
+    keys = (cell[:, 0] * grid + cell[:, 1]) * grid + cell[:, 2]
+    
+    order = np.argsort(keys, kind='mergesort')
+    splits = np.nonzero(np.diff(keys[order]))[0] + 1
+    return np.split(order, splits)
+
+# (nverts, P, width) of the given strands only
+def select_strands(strands, indices):
+    nverts, P, width = strands
+    starts = (np.cumsum(nverts) - nverts)[indices]
+    counts = nverts[indices]
+    verts = np.repeat(starts - (np.cumsum(counts) - counts), counts) + \
+                np.arange(counts.sum())
+    
+    return (counts, P.reshape(-1, 3)[verts].ravel(), 
+            None if width is None else width[verts])
+
+# Particle data access, every attribute the exporter needs is read 
+# with one foreach_get per attribute and filtered with a single mask
+particle_attributes = (('location', 3), ('rotation', 4), ('size', 1),
+                       ('velocity', 3), ('angular_velocity', 3),
+                       ('birth_time', 1), ('die_time', 1), ('lifetime', 1))
+
+def get_particle_snapshot(scene, psys):
+    particles = psys.particles
     cfra = scene.frame_current
     
-    for pa in [p for p in psys.particles if valid_particle(p, cfra)]:
-        
-        P.extend( pa.location )
-        rot.extend( pa.rotation )
-        
-        if pa.alive_state != 'ALIVE':
-            width.append(0.0)
-        else:
-            width.append(pa.size)
+    snapshot = {}
+    for attr, size in particle_attributes:
+        values = foreach_array(particles, attr, size)
+        snapshot[attr] = values.reshape(-1, size) if size > 1 else values
+    
+    # alive_state is an enum, which foreach_get can't read
+    snapshot['alive'] = np.array([pa.alive_state == 'ALIVE' 
+                                  for pa in particles], dtype=bool)
+    
+    # only export particles that are alive, 
+    # or have been born since the last frame
+    birth = snapshot['birth_time']
+    valid = ~((birth > cfra) | ((birth + snapshot['die_time']) < cfra))
+    
+    return dict((key, values[valid]) for key, values in snapshot.items())
+
+def get_particles(scene, ob, psys, snapshot=None):
+    if snapshot is None:
+        snapshot = get_particle_snapshot(scene, psys)
+    
+    P = snapshot['location'].ravel()
+    rot = snapshot['rotation'].ravel()
+    width = np.where(snapshot['alive'], snapshot['size'], 0.0)
     
     return (P, rot, width)
 
+# Bulk RNA access, reads a property of every item in a collection 
+# into a flat preallocated array with a single foreach_get call
+def foreach_array(collection, attr, size=1, dtype=np.float32):
+    values = np.empty(len(collection) * size, dtype=dtype)
+    collection.foreach_get(attr, values)
+    return values
+
 # Mesh data access
-def get_mesh(mesh):
-    nverts = []
-    verts = []
-    P = []
-    
-    for v in mesh.vertices:
-        P.extend( v.co )
-  
-    for p in mesh.polygons:
-        nverts.append( p.loop_total )
-        verts.extend( p.vertices )
+def get_mesh(mesh, faces=True):
+    P = foreach_array(mesh.vertices, 'co', 3)
+    if not faces:
+        return (None, None, P)
+    
+    nverts = foreach_array(mesh.polygons, 'loop_total', dtype=np.int32)
+    loop_start = foreach_array(mesh.polygons, 'loop_start', dtype=np.int32)
+    verts = foreach_array(mesh.loops, 'vertex_index', dtype=np.int32)
+    
+    # polygons normally store their loops in order, 
+    # only gather the loop indices when they don't
+    offsets = np.cumsum(nverts) - nverts
+    if not np.array_equal(loop_start, offsets):
+        verts = verts[np.repeat(loop_start - offsets, nverts) + 
+                        np.arange(len(verts))]
         
     return (nverts, verts, P)
 
 def get_mesh_vertex_N(mesh):
-    N = []
-    
-    for v in mesh.vertices:
-        N.extend( v.normal )
-    
-    return N
+    return foreach_array(mesh.vertices, 'normal', 3)
 
 # requires facevertex interpolation
 def get_mesh_uv(mesh, name=""):
-    uvs = []
-
     if name == "":
         uv_loop_layer = mesh.uv_layers.active
     else:
@@ -544,42 +590,53 @@ def get_mesh_uv(mesh, name=""):
     if uv_loop_layer == None:
         return None
     
-    for uvloop in uv_loop_layer.data:
-        uvs.append( uvloop.uv.x )
-        uvs.append( 1.0 - uvloop.uv.y )     
-        # renderman expects UVs flipped vertically from blender
+    uvs = foreach_array(uv_loop_layer.data, 'uv', 2).reshape(-1, 2)
+    # renderman expects UVs flipped vertically from blender
+    uvs[:, 1] = 1.0 - uvs[:, 1]
 
-    return uvs
+    return uvs.ravel()
 
 
 # requires facevertex interpolation
 def get_mesh_vcol(mesh, name=""):
     vcol_layer = mesh.vertex_colors[name] if name != "" \
          else mesh.vertex_colors.active
-    cols = []
     
     if vcol_layer == None:
         return None
     
-    for vcloop in vcol_layer.data:
-        cols.extend( vcloop.color )
+    return foreach_array(vcol_layer.data, 'color', 3)
+
+# sparse (vertex, group, weight) table of every vertex group assignment,
+# gathered in a single pass over the mesh vertices
+def get_mesh_vgroup_table(mesh):
+    counts = np.empty(len(mesh.vertices), dtype=np.int32)
+    assignments = []
+    
+    for i, v in enumerate(mesh.vertices):
+        counts[i] = len(v.groups)
+        assignments.extend( (g.group, g.weight) for g in v.groups )
     
-    return cols
+    vertex = np.repeat(np.arange(len(counts), dtype=np.int32), counts)
+    assignments = np.array(assignments, dtype=np.float32).reshape(-1, 2)
+    
+    return (vertex, assignments[:, 0].astype(np.int32), assignments[:, 1])
 
 # requires per-vertex interpolation
-def get_mesh_vgroup(ob, mesh, name=""):
+def get_mesh_vgroup(ob, mesh, name="", table=None):
     vgroup = ob.vertex_groups[name] if name != "" else ob.vertex_groups.active
-    weights = []
     
     if vgroup == None:
         return None
-
-    for v in mesh.vertices:
-        if len(v.groups) == 0:
-            weights.append(0.0)
-        else:
-            weights.extend( [g.weight for g in v.groups \
-                    if g.group == vgroup.index ] )
+    
+    if table is None:
+        table = get_mesh_vgroup_table(mesh)
+    vertex, group, weight = table
+    
+    # vertices outside the group get a zero weight
+    weights = np.zeros(len(mesh.vertices), dtype=np.float32)
+    in_group = group == vgroup.index
+    weights[vertex[in_group]] = weight[in_group]
             
     return weights
 
@@ -593,6 +650,22 @@ def get_primvars(ob, geo, interpolation=""):
 
     interpolation = 'facevertex' if interpolation == '' else interpolation
     
+    # each data layer is read only once, 
+    # even when several prim vars are exported from it
+    layers = {}
+
+    def layer(get_layer, collection, name):
+        if name == "" and collection.active != None:
+            name = collection.active.name
+        if (get_layer, name) not in layers:
+            layers[(get_layer, name)] = get_layer(geo, name)
+        return layers[(get_layer, name)]
+
+    def vgroup_weights(name):
+        if 'VERTEX_GROUP' not in layers:
+            layers['VERTEX_GROUP'] = get_mesh_vgroup_table(geo)
+        return get_mesh_vgroup(ob, geo, name, layers['VERTEX_GROUP'])
+    
     # default hard-coded prim vars
     if rm.export_smooth_normals and ob.renderman.primitive in \
             ('AUTO', 'POLYGON_MESH', 'SUBDIVISION_MESH'):
@@ -600,77 +673,60 @@ def get_primvars(ob, geo, interpolation=""):
         if N is not None:
             primvars["varying normal N"] = N
     if rm.export_default_uv:
-        uvs = get_mesh_uv(geo)
+        uvs = layer(get_mesh_uv, geo.uv_textures, "")
         if uvs is not None:
             primvars["%s float[2] st" % interpolation] = uvs
     if rm.export_default_vcol:
-        vcols = get_mesh_vcol(geo)
+        vcols = layer(get_mesh_vcol, geo.vertex_colors, "")
         if vcols is not None:
-            primvars["%s color Cs" % interpolation] = rib(vcols)
+            primvars["%s color Cs" % interpolation] = vcols
     
     # custom prim vars
     for p in rm.prim_vars:
         if p.data_source == 'VERTEX_COLOR':
-            vcols = get_mesh_vcol(geo, p.data_name)
+            vcols = layer(get_mesh_vcol, geo.vertex_colors, p.data_name)
             if vcols is not None:
-                primvars["%s color %s" % (interpolation, p.name)] = rib(vcols)
+                primvars["%s color %s" % (interpolation, p.name)] = vcols
 
         elif p.data_source == 'UV_TEXTURE':
-            uvs = get_mesh_uv(geo, p.data_name)
+            uvs = layer(get_mesh_uv, geo.uv_textures, p.data_name)
             if uvs is not None:
                 primvars["%s float[2] %s" % (interpolation, p.name)] = uvs
 
         elif p.data_source == 'VERTEX_GROUP':
-            weights = get_mesh_vgroup(ob, geo, p.data_name)
+            weights = vgroup_weights(p.data_name)
             if weights is not None:
                 primvars["vertex float %s" % p.name] = weights
 
     return primvars
     
-def get_primvars_particle(file, scene, psys):
+def get_primvars_particle(scene, psys, snapshot=None):
     primvars = {}
     rm = psys.settings.renderman
     cfra = scene.frame_current
     
+    if snapshot is None:
+        snapshot = get_particle_snapshot(scene, psys)
+    
     for p in rm.prim_vars:
-        pvars = []
-        
-        if p.data_source in ('VELOCITY', 'ANGULAR_VELOCITY'):
-            if p.data_source == 'VELOCITY':
-                for pa in \
-                        [p for p in psys.particles if valid_particle(p, cfra)]:
-                    pvars.extend ( pa.velocity )
-            elif p.data_source == 'ANGULAR_VELOCITY':
-                for pa in \
-                        [p for p in psys.particles if valid_particle(p, cfra)]:
-                    pvars.extend ( pa.angular_velocity )
-
-            primvars["varying float[3] %s" % p.name] = pvars
-
-        elif p.data_source in \
-                ('SIZE', 'AGE', 'BIRTH_TIME', 'DIE_TIME', 'LIFE_TIME'):
-            if p.data_source == 'SIZE':
-                for pa in \
-                        [p for p in psys.particles if valid_particle(p, cfra)]:
-                    pvars.append ( pa.size )
-            elif p.data_source == 'AGE':
-                for pa in \
-                        [p for p in psys.particles if valid_particle(p, cfra)]:
-                    pvars.append ( (cfra - pa.birth_time) / pa.lifetime )
-            elif p.data_source == 'BIRTH_TIME':
-                for pa in \
-                        [p for p in psys.particles if valid_particle(p, cfra)]:
-                    pvars.append ( pa.birth_time )
-            elif p.data_source == 'DIE_TIME':
-                for pa in \
-                        [p for p in psys.particles if valid_particle(p, cfra)]:
-                    pvars.append ( pa.die_time )
-            elif p.data_source == 'LIFE_TIME':
-                for pa in \
-                        [p for p in psys.particles if valid_particle(p, cfra)]:
-                    pvars.append ( pa.lifetime )
-
-            primvars["varying float %s" % p.name] = pvars
+        if p.data_source == 'VELOCITY':
+            primvars["varying float[3] %s" % p.name] = \
+                snapshot['velocity'].ravel()
+        elif p.data_source == 'ANGULAR_VELOCITY':
+            primvars["varying float[3] %s" % p.name] = \
+                snapshot['angular_velocity'].ravel()
+
+        elif p.data_source == 'SIZE':
+            primvars["varying float %s" % p.name] = snapshot['size']
+        elif p.data_source == 'AGE':
+            primvars["varying float %s" % p.name] = \
+                (cfra - snapshot['birth_time']) / snapshot['lifetime']
+        elif p.data_source == 'BIRTH_TIME':
+            primvars["varying float %s" % p.name] = snapshot['birth_time']
+        elif p.data_source == 'DIE_TIME':
+            primvars["varying float %s" % p.name] = snapshot['die_time']
+        elif p.data_source == 'LIFE_TIME':
+            primvars["varying float %s" % p.name] = snapshot['lifetime']
 
     return primvars
 
@@ -683,30 +739,75 @@ def get_fluid_mesh(scene, ob):
     fluidmod = [m for m in ob.modifiers if m.type == 'FLUID_SIMULATION'][0]
     fluidmeshverts = fluidmod.settings.fluid_mesh_vertices
     
-    mesh = create_mesh(scene, ob)
-    (nverts, verts, P) = get_mesh(mesh)
-    bpy.data.meshes.remove(mesh)
+    mesh = cached_mesh(scene, ob, export_mesh_users(scene, ob))
+    (nverts, verts, P) = get_mesh(mesh, get_mesh_plan(ob)['faces'])
+    release_mesh(scene, ob)
     
     # use fluid vertex velocity vectors to reconstruct moving points
-    P = [P[i] + fluidmeshverts[int(i/3)].velocity[i%3] * subframe * 0.5 for \
-        i in range(len(P))]
+    P = P + foreach_array(fluidmeshverts, 'velocity', 3) * subframe * 0.5
     
     return (nverts, verts, P)
     
+# join connected crease edges into the longest possible vertex chains,
+# a chain only stops at vertices not shared by exactly two of the edges
+def get_crease_chains(edges):
+    neighbours = {}
+    for a, b in edges:
+        neighbours.setdefault(a, []).append(b)
+        neighbours.setdefault(b, []).append(a)
+    
+    visited = set()
+    
+    def walk(start, current):
+        chain = [start]
+        visited.add((min(start, current), max(start, current)))
+        while True:
+            chain.append(current)
+            if len(neighbours[current]) != 2:
+                break
+            following = [n for n in neighbours[current] \
+                            if (min(current, n), max(current, n)) not in visited]
+            if len(following) == 0:
+                # back at the start of a closed loop
+                break
+            visited.add((min(current, following[0]), max(current, following[0])))
+            current = following[0]
+        return chain
+    
+    chains = []
+    # open chains run between ends and junctions
+    for v, vns in neighbours.items():
+        if len(vns) != 2:
+            chains.extend( walk(v, n) for n in vns \
+                            if (min(v, n), max(v, n)) not in visited )
+    # whatever is left over are closed loops
+    for v, vns in neighbours.items():
+        chains.extend( walk(v, n) for n in vns \
+                        if (min(v, n), max(v, n)) not in visited )
+    
+    return chains
+
 def get_subd_creases(mesh):
     creases = []
     
-    # only do creases 1 edge at a time for now, 
-    #detecting chains might be tricky..
-    for e in mesh.edges:
-        if e.crease > 0.0:
-            creases.append( (e.vertices[0], e.vertices[1], 
-                                e.crease*e.crease * 10) ) 
-            # squared, to match blender appareance better 
-            #: range 0 - 10 (infinitely sharp)
+    crease = foreach_array(mesh.edges, 'crease')
+    edges = foreach_array(mesh.edges, 'vertices', 2, np.int32).reshape(-1, 2)
+    edges = edges[crease > 0.0]
+    # squared, to match blender appareance better 
+    #: range 0 - 10 (infinitely sharp)
+    sharpness = crease[crease > 0.0] ** 2 * 10
+    
+    # only edges of equal sharpness can share a tag
+    for value in np.unique(sharpness):
+        for chain in get_crease_chains(edges[sharpness == value].tolist()):
+            creases.append( (chain, float(value)) )
+    
+    debug("info", "get_subd_creases: %d creased edges in %d tags, %d saved" % 
+        (len(edges), len(creases), len(edges) - len(creases)))
     return creases
 
-def create_mesh(scene, ob, matrix=None):
+def create_mesh(scene, ob, matrix=None, calc_tessface=False, 
+                calc_undeformed=False):
     # 2 special cases to ignore:
     # subsurf last or subsurf 2nd last +displace last
     
@@ -716,11 +817,125 @@ def create_mesh(scene, ob, matrix=None):
     #    ob.modifiers[len(ob.modifiers)-2].show_render = False
     #    ob.modifiers[len(ob.modifiers)-1].show_render = False
     
-    mesh = ob.to_mesh(scene, True, 'RENDER', calc_tessface=True, calc_undeformed=True)    
+    mesh = ob.to_mesh(scene, True, 'RENDER', calc_tessface=calc_tessface, 
+                        calc_undeformed=calc_undeformed)
     if matrix != None:
         mesh.transform(matrix)
 
     return mesh
+
+# The derived mesh data the export of an object needs, depending on its 
+# primitive. Only points are read from the mesh of other primitives, 
+# prim vars and creases decide for themselves what they read.
+def get_mesh_plan(ob):
+    prim = detect_primitive(ob)
+    
+    return {
+        'faces': prim in ('POLYGON_MESH', 'SUBDIVISION_MESH'),
+        }
+
+# time spent evaluating each object's mesh, and what its plan skipped
+mesh_timings = {}
+
+def report_mesh_timings():
+    for name, (elapsed, skipped) in sorted(mesh_timings.items()):
+        debug("info", "mesh [%s]: %.3fs in to_mesh, skipped %s" % (name, 
+                elapsed, ', '.join(sorted(skipped)) if skipped else 'nothing'))
+    mesh_timings.clear()
+
+# Evaluated meshes shared by the motion blur pre-pass and the final export,
+# keyed by object, frame, subframe and the render state of its modifiers.
+# Each entry counts the export stages that still have to read it, 
+# and is removed as soon as the last of them releases it.
+mesh_cache = {}
+
+def mesh_cache_key(scene, ob):
+    return (ob.name, scene.frame_current, scene.frame_subframe, 
+            tuple((m.name, m.type, m.show_render) for m in ob.modifiers))
+
+# users is the number of stages that will read the mesh, 
+# including the caller, a cached entry already counts the caller
+def cached_mesh(scene, ob, users=1):
+    key = mesh_cache_key(scene, ob)
+    if key in mesh_cache:
+        mesh_cache[key][1] += users - 1
+    else:
+        plan = get_mesh_plan(ob)
+        start = time.time()
+        mesh = create_mesh(scene, ob)
+        
+        timing = mesh_timings.setdefault(ob.name, [0.0, set()])
+        timing[0] += time.time() - start
+        timing[1].update(data for data, needed in plan.items() if not needed)
+        
+        mesh_cache[key] = [mesh, users]
+    
+    return mesh_cache[key][0]
+
+def release_mesh(scene, ob):
+    key = mesh_cache_key(scene, ob)
+    if key not in mesh_cache:
+        return
+    
+    mesh_cache[key][1] -= 1
+    if mesh_cache[key][1] <= 0:
+        bpy.data.meshes.remove(mesh_cache.pop(key)[0])
+
+def clear_mesh_cache():
+    for mesh, users in mesh_cache.values():
+        try:
+            bpy.data.meshes.remove(mesh)
+        except:
+            # already freed along with the file it came from
+            pass
+    mesh_cache.clear()
+
+# Dupli lists, created once per object, frame and subframe. The duplis 
+# of an object are stored as an (N,16) array of their matrices, which 
+# foreach_get already returns in RIB order, their hide flags and dupli 
+# indices, and the position of each one's object in a list of sources.
+dupli_cache = {}
+
+def get_duplis(scene, ob):
+    key = (ob.name, scene.frame_current, scene.frame_subframe)
+    if key in dupli_cache:
+        return dupli_cache[key]
+    
+    ob.dupli_list_create(scene, 'RENDER')
+    dupli_list = ob.dupli_list
+    
+    matrices = foreach_array(dupli_list, 'matrix', 16).reshape(-1, 16)
+    hide = foreach_array(dupli_list, 'hide', dtype=bool)
+    index = foreach_array(dupli_list, 'index', dtype=np.int32)
+    
+    # object pointers can't be read in bulk, 
+    # only one reference to each distinct object is kept
+    sources = []
+    positions = {}
+    source = np.empty(len(hide), dtype=np.int32)
+    for i, dob in enumerate(dupli_list):
+        if dob.object not in positions:
+            positions[dob.object] = len(sources)
+            sources.append(dob.object)
+        source[i] = positions[dob.object]
+    
+    ob.dupli_list_clear()
+    
+    dupli_cache[key] = {'matrices': matrices, 'hide': hide, 'index': index, 
+                        'source': source, 'sources': sources}
+    return dupli_cache[key]
+
+def clear_dupli_cache():
+    dupli_cache.clear()
+
+# the motion pre-pass ends on the frame that is exported, meshes evaluated 
+# there are kept when the final export reads their faces and prim vars,
+# which it only does for renderable objects
+def export_mesh_users(scene, ob):
+    if scene.frame_subframe == 0.0 and get_mesh_plan(ob)['faces'] and \
+            ob.name in get_scene_index(scene)['renderable_names']:
+        return 2
+    return 1
  
 
 def export_light(rpass, scene, ri, ob):
@@ -904,6 +1119,27 @@ def export_material(ri, rpass, scene, mat):
         export_shader(ri, scene, rpass, mat, 'interior')
     
     
+# Every material used by the scene is written once, as an inline archive 
+# near the top of the world block, objects and instances then only read 
+# it by handle instead of repeating the whole shader network
+def export_material_archives(ri, rpass, scene):
+    export_comment(ri, '## MATERIALS')
+    for mat in get_scene_index(scene)['materials']:
+        handle = MATERIAL_PREFIX + mat.name
+        ri.ArchiveBegin(handle)
+        export_material(ri, rpass, scene, mat)
+        ri.ArchiveEnd()
+        rpass.material_archives[mat.name] = handle
+
+# materials outside of the registry, like those of objects only
+# reached through groups, are still written in place
+def bind_material(ri, rpass, scene, mat):
+    handle = getattr(rpass, 'material_archives', {}).get(mat.name)
+    if handle != None:
+        ri.ReadArchive(handle)
+    else:
+        export_material(ri, rpass, scene, mat)
+
 def export_motion_begin(ri, scene, ob):
     ri.MotionBegin(get_ob_subframes(scene, ob))
 
@@ -925,19 +1161,73 @@ def export_strands(ri, rpass, scene, ob, motion):
         motion_blur = pname in motion['deformation']
             
         if motion_blur:
-            export_motion_begin(ri, scene, ob)
             samples = motion['deformation'][pname]
         else:
-            get_strands(ri, scene,ob, psys)
+            samples = [get_strands(scene, ob, psys)]
         
-        #for nverts, P in samples:
+        ri.Basis("CatmullRomBasis", 1, "CatmullRomBasis", 1)
+        ri.Attribute("dice", {"int roundcurve": 1, "int hair": 1})
+        
+        # the whole system goes out in a few Curves calls, 
+        # each holding many strands, optionally grouped spatially
+        if rm.hair_chunking == 'NONE':
+            groups = get_strand_batches(samples[0][0], rm.strand_batches)
+        else:
+            groups = get_strand_chunks(samples[0], rm.hair_chunk_grid)
+
+        for i, indices in enumerate(groups):
+            chunk_samples = [select_strands(strands, indices) \
+                                for strands in samples]
+            
+            def export_chunk():
+                export_curves(ri, scene, ob, chunk_samples, rm.width, 
+                                motion_blur)
             
-            #ri.Basis("catmull-rom", 1, "catmull-rom", 1)
-            #ri.Curves("cubic", nverts, "nonperiodic", 
-                        #{"P": rib(P), "constantwidth": rm.width})
+            if rm.hair_chunking == 'NONE':
+                export_chunk()
+            else:
+                pad = rm.width if rm.constant_width else rm.base_width
+                bounds = get_bounds([P for nverts, P, width in chunk_samples], 
+                                    pad * 0.5)
+                export_bounded_chunk(ri, "%s_chunk%d" % (pname, i), bounds, 
+                                    rm.hair_chunking == 'DELAYED', export_chunk)
 
-        if motion_blur:
-            ri.MotionEnd()
+def export_curves(ri, scene, ob, samples, constant_width, motion_blur):
+    if motion_blur:
+        export_motion_begin(ri, scene, ob)
+    
+    for nverts, P, width in samples:
+        params = {"P": rib(P)}
+        if width is None:
+            params["constantwidth"] = constant_width
+        else:
+            params["vertex float width"] = rib(width)
+        ri.Curves("cubic", rib(nverts), "nonperiodic", params)
+
+    if motion_blur:
+        ri.MotionEnd()
+
+# bounding box of one or more flat position arrays, as a RIB bound
+def get_bounds(points, pad=0.0):
+    points = np.concatenate(points).reshape(-1, 3)
+    lo = points.min(axis=0) - pad
+    hi = points.max(axis=0) + pad
+    return [float(lo[0]), float(hi[0]), float(lo[1]), float(hi[1]), 
+            float(lo[2]), float(hi[2])]
+
+# write a block of geometry with a tight bound, either inline or as an 
+# inline archive that is only expanded when its bound is visible
+def export_bounded_chunk(ri, handle, bounds, delayed, export_chunk):
+    if delayed:
+        ri.ArchiveBegin(handle)
+        export_chunk()
+        ri.ArchiveEnd()
+        ri.Procedural("DelayedReadArchive", handle, bounds)
+    else:
+        ri.AttributeBegin()
+        ri.Bound(bounds)
+        export_chunk()
+        ri.AttributeEnd()
 
 def geometry_source_rib(ri, scene, ob):
     rm = ob.renderman
@@ -974,48 +1264,100 @@ def geometry_source_rib(ri, scene, ob):
                                         rib(bounds))
 
 
+# RIB transforms (translation * rotation * uniform scale) of all particles,
+# one row of 16 floats per particle
+def get_particle_matrices(P, rot, width):
+    loc = np.asarray(P, dtype=np.float64).reshape(-1, 3)
+    w, x, y, z = np.asarray(rot, dtype=np.float64).reshape(-1, 4).T
+    scale = np.asarray(width, dtype=np.float64)
+    
+    # columns of the rotation matrix of each quaternion
+    columns = [(1.0 - 2.0*(y*y + z*z), 2.0*(x*y + w*z), 2.0*(x*z - w*y)),
+                (2.0*(x*y - w*z), 1.0 - 2.0*(x*x + z*z), 2.0*(y*z + w*x)),
+                (2.0*(x*z + w*y), 2.0*(y*z - w*x), 1.0 - 2.0*(x*x + y*y))]
+    
+    matrices = np.zeros((len(scale), 16))
+    for c, column in enumerate(columns):
+        for r, value in enumerate(column):
+            matrices[:, c*4 + r] = value * scale
+    matrices[:, 12:15] = loc
+    matrices[:, 15] = 1.0
+    
+    return matrices
+
+# Instanced objects are defined once per export as an ObjectBegin master, 
+# shared by every particle system instancing them
+def particle_instance_master(ri, rpass, scene, instance_ob, motion):
+    if instance_ob.name not in rpass.instance_masters:
+        handle = ri.ObjectBegin()
+        if instance_ob.renderman.geometry_source == 'BLENDER_SCENE_DATA':
+            export_geometry(ri, rpass, scene, instance_ob, motion)
+        else:
+            geometry_source_rib(ri, scene, instance_ob)
+        ri.ObjectEnd()
+        rpass.instance_masters[instance_ob.name] = handle
+    
+    return rpass.instance_masters[instance_ob.name]
+
 def export_particle_instances(ri, rpass, scene, ob, psys, motion):
     rm = psys.settings.renderman
     pname = psys_motion_name(ob, psys)
     
-    # Precalculate archive path for object instances
+    # Object instanced on every particle
     try:
         instance_ob = bpy.data.objects[rm.particle_instance_object]
     except:
         return
     
     motion_blur = pname in motion['deformation']
-    cfra = scene.frame_current
+    
+    if motion_blur:
+        samples = motion['deformation'][pname]
+    else:
+        samples = [get_particles(scene, ob, psys)]
+    
+    # particles are read once per sample and 
+    # all of their matrices are built together
+    matrices = [get_particle_matrices(P, rot, width).tolist() \
+                    for P, rot, width in samples]
+    
+    instance_handle = particle_instance_master(ri, rpass, scene, instance_ob, 
+                                                motion)
 
-    for i in range(len( [ p for p in psys.particles \
-                                    if valid_particle(p, cfra) ] )):
+    for i in range(min(len(m) for m in matrices)):
         
         if motion_blur:
             export_motion_begin(ri, scene, ob)
-            samples = motion['deformation'][pname]
-        else:
-            samples = [get_particles(scene, ob, psys)]
         
-        for P, rot, width in samples:
-
-            loc = Vector((P[i*3+0], P[i*3+1], P[i*3+2]))
-            rot = Quaternion((rot[i*4+0], rot[i*4+1], rot[i*4+2], rot[i*4+3]))
-            mtx = Matrix.Translation(loc) * rot.to_matrix().to_4x4() \
-                    * Matrix.Scale(width[i], 4)
-            
-            ri.Transform(rib(mtx))
+        for sample_matrices in matrices:
+            ri.Transform(sample_matrices[i])
         
         if motion_blur:
             ri.MotionEnd()
 
-        if instance_ob.renderman.geometry_source == 'BLENDER_SCENE_DATA':
-            archive_path = rib_path(auto_archive_path(rpass.paths, 
-                                                        [instance_ob]))
-            ri.ReadArchive(archive_path)
-        else:
-            geometry_source_rib(ri, scene, instance_ob)
-        
+        ri.ObjectInstance(instance_handle)
+
 
+# order of the points along a Morton curve over their bounding box, 
+# so that consecutive runs of the order are spatially coherent
+def get_morton_order(P, bits=10):
+    P = P.reshape(-1, 3)
+    lo = P.min(axis=0)
+    extent = np.maximum(P.max(axis=0) - lo, 1e-8)
+    cells = ((P - lo) / extent * ((1 << bits) - 1)).astype(np.int64)
+    
+    codes = np.zeros(len(P), dtype=np.int64)
+    for b in range(bits):
+        for axis in range(3):
+            codes |= ((cells[:, axis] >> b) & 1) << (3 * b + axis)
+    
+    return np.argsort(codes, kind='mergesort')
+
+# (P, rot, width) of the given particles only
+def select_particles(particles, indices):
+    P, rot, width = particles
+    return (P.reshape(-1, 3)[indices].ravel(), 
+            rot.reshape(-1, 4)[indices].ravel(), width[indices])
 
 def export_particle_points(ri, scene, ob, psys, motion):
     rm = psys.settings.renderman
@@ -1023,20 +1365,61 @@ def export_particle_points(ri, scene, ob, psys, motion):
     
     motion_blur = pname in motion['deformation']
     
+    # one snapshot of the current frame feeds both P and the primvars
+    snapshot = get_particle_snapshot(scene, psys)
+    
     if motion_blur:
-        export_motion_begin(ri, scene, ob)
         samples = motion['deformation'][pname]
     else:
-        samples = [get_particles(scene, ob, psys)]
+        samples = [get_particles(scene, ob, psys, snapshot)]
+    
+    primvars = get_primvars_particle(scene, psys, snapshot)
+    
+    if rm.points_chunking == 'NONE':
+        write_particle_points(ri, scene, ob, rm, samples, primvars, motion_blur)
+        return
+    
+    # chunks are built and written one at a time, only the 
+    # points of the current chunk are ever converted to lists
+    count = min(len(width) for P, rot, width in samples)
+    if count == 0:
+        return
+    order = get_morton_order(samples[0][0][:count * 3])
+    
+    for i, start in enumerate(range(0, count, rm.points_chunk_size)):
+        indices = order[start:start + rm.points_chunk_size]
+        chunk_samples = [select_particles(particles, indices) \
+                            for particles in samples]
+        chunk_primvars = dict((name, 
+                    values.reshape(len(snapshot['size']), -1)[indices].ravel())
+                    for name, values in primvars.items())
+        
+        def export_chunk():
+            write_particle_points(ri, scene, ob, rm, chunk_samples, chunk_primvars,
+                            motion_blur)
+        
+        if rm.constant_width:
+            pad = rm.width
+        else:
+            pad = max(float(width.max()) for P, rot, width in chunk_samples)
+        bounds = get_bounds([P for P, rot, width in chunk_samples], pad * 0.5)
+        export_bounded_chunk(ri, "%s_chunk%d" % (pname, i), bounds, 
+                            rm.points_chunking == 'DELAYED', export_chunk)
+
+def write_particle_points(ri, scene, ob, rm, samples, primvars, motion_blur):
+    if motion_blur:
+        export_motion_begin(ri, scene, ob)
+    
+    primvars = rib_params(primvars)
     
     for P, rot, width in samples:
-        params = get_primvars_particle(scene, psys)
+        params = dict(primvars)
         params[ri.P] =  rib(P)
         params["uniform string type"] = rm.particle_type
         if rm.constant_width:
             params["constantwidth"] = rm.width
         elif rm.export_default_size:
-            params["varying float width"] = width
+            params["varying float width"] = rib(width)
         ri.Points(params)
     
     if motion_blur:
@@ -1058,7 +1441,7 @@ def export_particles(ri, rpass, scene, ob, motion):
         if ob.data.materials:
             if ob.data.materials[rm.material_id-1] != None:
                 mat = ob.data.materials[rm.material_id-1]
-                export_material(ri, rpass, scene, mat)
+                bind_material(ri, rpass, scene, mat)
         
         # Write object instances or points
         if rm.particle_type == 'OBJECT':
@@ -1075,18 +1458,17 @@ def export_comment(ri, comment):
 def get_texture_list(scene):
     #if not rpass.light_shaders: return
     SUPPORTED_MATERIAL_TYPES = ['MESH','CURVE','FONT']
+    index = get_scene_index(scene)
     textures = []
-    for o in renderable_objects(scene):
-        if o.type == 'CAMERA':
-            continue
-        elif o.type == 'LAMP':
-            if o.data.renderman.nodetree != '':
-                textures = textures + get_textures(o.data)
-        elif o.type in SUPPORTED_MATERIAL_TYPES:
-            for mat in [mat for mat in o.data.materials if mat != None]:
-                textures = textures + get_textures(mat)
-        else:
-            debug ("error","get_texture_list: unsupported object type [%s]." % o.type)
+    for o in index['types'].get('LAMP', []):
+        if o.data.renderman.nodetree != '':
+            textures = textures + get_textures(o.data)
+    
+    # each material is only visited once, however many objects use it
+    for mat, obs in index['materials'].items():
+        if any(o.type in SUPPORTED_MATERIAL_TYPES and \
+                mat.name in o.data.materials for o in obs):
+            textures = textures + get_textures(mat)
     return textures
 
 def get_texture_list_preview(scene):
@@ -1100,7 +1482,7 @@ def export_scene_lights(ri, rpass, scene):
 
     export_comment(ri,'##Lights')
     
-    for ob in [o for o in rpass.objects if o.type == 'LAMP']:
+    for ob in get_scene_index(scene)['types'].get('LAMP', []):
         export_light(rpass, scene, ri, ob)
     
 '''def export_shader_init(ri, rpass, mat):
@@ -1295,8 +1677,25 @@ def export_curve(ri, scene, ob, motion):
     else:
         debug ("error","export_curve: recieved a non-supported object type of [%s]." % ob.type)
 
+def get_subd_tags(creases):
+    tags = []
+    nargs = []
+    intargs = []
+    floatargs = []
+
+    for chain, sharpness in creases:
+        tags.append( 'crease' )
+        nargs.extend( [len(chain), 1] )
+        intargs.extend( chain )
+        floatargs.append( sharpness )
+
+    tags.append('interpolateboundary')
+    nargs.extend( [0, 0] )
+    
+    return (tags, nargs, intargs, floatargs)
+
 def export_subdivision_mesh(ri, scene, ob, motion):
-    mesh = create_mesh(scene, ob)
+    mesh = cached_mesh(scene, ob)
     
     motion_blur = ob.name in motion['deformation']
     
@@ -1306,38 +1705,24 @@ def export_subdivision_mesh(ri, scene, ob, motion):
     else:
         samples = [get_mesh(mesh)]
     
-    creases = get_subd_creases(mesh)
+    tags, nargs, intargs, floatargs = get_subd_tags(get_subd_creases(mesh))
+    
+    primvars = rib_params(get_primvars(ob, mesh, "facevertex"))
     
     for nverts, verts, P in samples:
-        tags = []
-        nargs = []
-        intargs = []
-        floatargs = []
-
-        if len(creases) > 0:
-            for c in creases:
-                tags.append( '"crease"' )
-                nargs.extend( [2, 1] )
-                intargs.extend( [c[0], c[1]] )
-                floatargs.append( c[2] )
-
-        tags.append('interpolateboundary')
-        nargs.extend( [0, 0] )
-        
-        primvars = get_primvars(ob, mesh, "facevertex")
-        primvars[ri.P] = P
+        primvars[ri.P] = rib(P)
 
-        ri.SubdivisionMesh("catmull-clark", nverts, verts, tags, nargs, intargs,
-            floatargs, primvars)
+        ri.SubdivisionMesh("catmull-clark", rib(nverts), rib(verts), tags, 
+            nargs, intargs, floatargs, primvars)
     
     if motion_blur:
         ri.MotionEnd()
             
-    bpy.data.meshes.remove(mesh)
+    release_mesh(scene, ob)
 
 def export_polygon_mesh(ri, scene, ob, motion):
     debug("info","export_polygon_mesh [%s]" % ob.name)
-    mesh = create_mesh(scene, ob)
+    mesh = cached_mesh(scene, ob)
     
     motion_blur = ob.name in motion['deformation']
     
@@ -1346,12 +1731,13 @@ def export_polygon_mesh(ri, scene, ob, motion):
         samples = motion['deformation'][ob.name]
     else:
         samples = [get_mesh(mesh)]
+    
+    primvars = rib_params(get_primvars(ob, mesh, "facevarying"))
         
     for nverts, verts, P in samples:
-        primvars = get_primvars(ob, mesh, "facevarying")
-        primvars['P'] = P
+        primvars['P'] = rib(P)
         try:
-            ri.PointsPolygons(nverts, verts, primvars)
+            ri.PointsPolygons(rib(nverts), rib(verts), primvars)
             is_error = False
         except:
             # Activate the texture space for the offending object so it stands out in the viewport.
@@ -1361,21 +1747,21 @@ def export_polygon_mesh(ri, scene, ob, motion):
     if is_error == False:
         if motion_blur:
             ri.MotionEnd()
-    bpy.data.meshes.remove(mesh)
+    release_mesh(scene, ob)
 
 
 def export_points(ri, scene, ob, motion):
     rm = ob.renderman
     
-    mesh = create_mesh(scene, ob)
-    
     motion_blur = ob.name in motion['deformation']
     
+    # points only need positions, which the motion samples already hold
     if motion_blur:
         export_motion_begin(ri,scene, ob)
         samples = motion['deformation'][ob.name]
     else:
-        samples = [get_mesh(mesh)]
+        samples = [get_mesh(cached_mesh(scene, ob), faces=False)]
+        release_mesh(scene, ob)
         
     for nverts, verts, P in samples:
         params = {
@@ -1387,10 +1773,115 @@ def export_points(ri, scene, ob, motion):
             
     if motion_blur:
         ri.MotionEnd()
-            
-    bpy.data.meshes.remove(mesh)
 
 
+# polygons of a mesh grouped by material, from a single sort of their 
+# material indices. Each group holds its polygon mask, its loops, the
+# vertices it uses and its loops' vertex indices remapped onto those.
+def get_material_subsets(nverts, verts, material_index):
+    loop_material = np.repeat(material_index, nverts)
+    order = np.argsort(loop_material, kind='mergesort')
+    splits = np.nonzero(np.diff(loop_material[order]))[0] + 1
+    
+    subsets = []
+    for loops in np.split(order, splits):
+        if len(loops) == 0:
+            continue
+        index = int(loop_material[loops[0]])
+        used, remapped = np.unique(verts[loops], return_inverse=True)
+        subsets.append( (index, material_index == index, loops, used, 
+                        remapped.astype(np.int32)) )
+    
+    return subsets
+
+# cut per loop and per vertex prim vars down to a subset of the mesh
+def subset_primvars(primvars, nloops, npoints, loops, used):
+    subset = {}
+    for name, values in primvars.items():
+        if name.split()[0] in ('facevarying', 'facevertex'):
+            subset[name] = values.reshape(nloops, -1)[loops].ravel()
+        elif name.split()[0] in ('varying', 'vertex'):
+            subset[name] = values.reshape(npoints, -1)[used].ravel()
+        else:
+            subset[name] = values
+    
+    return subset
+
+# crease chains of a subset, split where they leave its vertices
+def subset_creases(creases, used):
+    lookup = dict((v, i) for i, v in enumerate(used.tolist()))
+    
+    subset = []
+    for chain, sharpness in creases:
+        run = []
+        for v in chain + [None]:
+            if v in lookup:
+                run.append(lookup[v])
+                continue
+            if len(run) > 1:
+                subset.append( (run, sharpness) )
+            run = []
+    
+    return subset
+
+# A mesh with several materials is written as one primitive per material,
+# cut directly out of the evaluated mesh arrays
+def export_multi_material_mesh(ri, rpass, scene, ob, motion):
+    prim = detect_primitive(ob)
+    mesh = cached_mesh(scene, ob)
+    
+    motion_blur = ob.name in motion['deformation']
+    
+    if motion_blur:
+        samples = motion['deformation'][ob.name]
+    else:
+        samples = [get_mesh(mesh)]
+    
+    nverts, verts, P = samples[0]
+    material_index = foreach_array(mesh.polygons, 'material_index', 
+                                    dtype=np.int32)
+    materials = list(mesh.materials)
+    
+    if prim == 'SUBDIVISION_MESH':
+        primvars = get_primvars(ob, mesh, "facevertex")
+        creases = get_subd_creases(mesh)
+    else:
+        primvars = get_primvars(ob, mesh, "facevarying")
+    
+    release_mesh(scene, ob)
+    
+    for index, polygons, loops, used, remapped in \
+            get_material_subsets(nverts, verts, material_index):
+        ri.AttributeBegin()
+        
+        if index < len(materials) and materials[index] != None:
+            bind_material(ri, rpass, scene, materials[index])
+        
+        sub_nverts = rib(nverts[polygons])
+        sub_verts = rib(remapped)
+        sub_primvars = rib_params(subset_primvars(primvars, len(verts), 
+                                                    len(P) // 3, loops, used))
+        if prim == 'SUBDIVISION_MESH':
+            tags, nargs, intargs, floatargs = \
+                get_subd_tags(subset_creases(creases, used))
+        
+        if motion_blur:
+            export_motion_begin(ri, scene, ob)
+        
+        for sample_nverts, sample_verts, sample_P in samples:
+            sub_primvars[ri.P] = rib(sample_P.reshape(-1, 3)[used].ravel())
+            
+            if prim == 'SUBDIVISION_MESH':
+                ri.SubdivisionMesh("catmull-clark", sub_nverts, sub_verts, 
+                    tags, nargs, intargs, floatargs, sub_primvars)
+            else:
+                ri.PointsPolygons(sub_nverts, sub_verts, sub_primvars)
+        
+        if motion_blur:
+            ri.MotionEnd()
+        
+        ri.AttributeEnd()
+
 def export_sphere(ri, scene, ob, motion):
     rm = ob.renderman
     ri.Sphere(rm.primitive_radius, rm.primitive_zmin, rm.primitive_zmax, 
@@ -1434,9 +1925,17 @@ def export_geometry_data(ri, rpass, scene, ob, motion, force_prim=''):
 
     if ob.data and ob.data.materials:
         for mat in [mat for mat in ob.data.materials if mat != None]:
-            export_material(ri, rpass, scene, mat)
+            bind_material(ri, rpass, scene, mat)
             break
     
+    # materials stay outside of cached archives, 
+    # so shading changes never invalidate them
+    if use_geometry_cache(scene, ob, motion, prim):
+        export_cached_geometry(ri, rpass, scene, ob, motion, prim)
+    else:
+        export_primitive(ri, scene, ob, motion, prim)
+
+def export_primitive(ri, scene, ob, motion, prim):
     if prim == 'SPHERE':
         export_sphere(ri, scene, ob, motion)
     elif prim == 'CYLINDER':
@@ -1465,6 +1964,228 @@ def export_geometry_data(ri, rpass, scene, ob, motion, force_prim=''):
     elif prim == 'POINTS':
         export_points(ri, scene, ob, motion)
   
+# ------------- Geometry Cache -------------
+# Geometry blocks are written to archives named after a hash of everything
+# that goes into them, and read back while the hash still matches
+
+def geometry_cache_dir(paths):
+    return os.path.join(paths['export_dir'], "archive_cache")
+
+# remove the archives no export has used for the scene's maximum age,
+# archives left by past edits would otherwise pile up forever
+def prune_geometry_cache(scene, paths):
+    cache_dir = geometry_cache_dir(paths)
+    if not os.path.isdir(cache_dir):
+        return
+    oldest = time.time() - scene.renderman.geometry_cache_max_age * 86400
+    for f in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, f)
+        try:
+            if os.path.getmtime(path) < oldest:
+                os.remove(path)
+                debug("info", "geometry cache evicted %s" % f)
+        except:
+            # removed by another export meanwhile
+            pass
+
+# only static mesh based geometry is written the same on every export
+def is_hashable_geometry(ob, motion, prim):
+    return prim in ('POLYGON_MESH', 'SUBDIVISION_MESH', 'POINTS') and \
+        ob.name not in motion['deformation']
+
+def use_geometry_cache(scene, ob, motion, prim):
+    return scene.renderman.geometry_cache and \
+        is_hashable_geometry(ob, motion, prim)
+
+# the object settings written into its geometry block, 
+# lighting and visibility settings are written around it
+def is_geometry_setting(key):
+    return key in ('primitive', 'geometry_source') or \
+        key.startswith('primitive_')
+
+# the mesh and curve settings written into the geometry block, leaving 
+# out the selections of their lists in the ui
+def is_data_setting(key):
+    return not key.endswith('_index')
+
+# the renderman settings of a property group as a string, 
+# nested groups included and datablocks by name, 
+# only the settings accepted by include when it's given
+def renderman_signature(prop_group, include=None):
+    if prop_group == None:
+        return ''
+    
+    values = []
+    for key, prop in sorted(prop_group.bl_rna.properties.items()):
+        if key in ('rna_type', 'name'):
+            continue
+        if include != None and not include(key):
+            continue
+        value = getattr(prop_group, key)
+        if prop.type == 'COLLECTION':
+            value = [renderman_signature(item) for item in value]
+        elif prop.type == 'POINTER':
+            value = value.name if isinstance(value, bpy.types.ID) \
+                        else renderman_signature(value)
+        else:
+            value = rib(value)
+        values.append( (key, value) )
+    
+    return repr(values)
+
+# hash of everything that goes into the geometry block of an object, and
+# the size of the arrays hashed. With keep_mesh the evaluated mesh stays in
+# the mesh cache for one more user, when the geometry is exported next.
+def geometry_hash(scene, ob, prim, keep_mesh=True):
+    sha = hashlib.sha1()
+    sha.update(repr((addon_version, prim)).encode())
+    sha.update(renderman_signature(ob.renderman, 
+                                   is_geometry_setting).encode())
+    sha.update(renderman_signature(getattr(ob.data, 'renderman', None), 
+                                   is_data_setting).encode())
+    
+    mesh = cached_mesh(scene, ob, 2 if keep_mesh else 1)
+    faces = prim != 'POINTS'
+    
+    arrays = [('geometry', array) for array in get_mesh(mesh, faces) \
+                if array is not None]
+    if faces:
+        interpolation = "facevertex" if prim == 'SUBDIVISION_MESH' \
+                            else "facevarying"
+        arrays.extend(sorted(get_primvars(ob, mesh, interpolation).items()))
+        if prim == 'SUBDIVISION_MESH':
+            sha.update(repr(get_subd_creases(mesh)).encode())
+    
+    release_mesh(scene, ob)
+    
+    nbytes = 0
+    for name, array in arrays:
+        array = np.ascontiguousarray(array)
+        sha.update(repr((name, array.dtype.str, array.shape)).encode())
+        sha.update(array.tobytes())
+        nbytes += array.nbytes
+    
+    return (sha.hexdigest(), nbytes)
+
+def export_cached_geometry(ri, rpass, scene, ob, motion, prim):
+    cache_dir = geometry_cache_dir(rpass.paths)
+    archive_path = os.path.join(cache_dir, "%s.rib" % 
+                                geometry_hash(scene, ob, prim)[0])
+    
+    if os.path.exists(archive_path):
+        debug("info", "geometry cache hit [%s]" % ob.name)
+        release_mesh(scene, ob)
+        # the modification time is when the archive was last used
+        os.utime(archive_path)
+    else:
+        debug("info", "geometry cache miss [%s]" % ob.name)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        
+        # written aside and renamed, so an interrupted export 
+        # never leaves a partial archive behind
+        context = ri.GetContext()
+        ri.Begin(archive_path + ".tmp")
+        try:
+            try:
+                export_primitive(ri, scene, ob, motion, prim)
+            finally:
+                ri.End()
+                ri.Context(context)
+        except:
+            os.remove(archive_path + ".tmp")
+            raise
+        os.replace(archive_path + ".tmp", archive_path)
+    
+    ri.ReadArchive(rib_path(archive_path))
+
+# objects whose geometry may be written once and instanced
+def is_instanceable(ob, motion, prim):
+    return not ob.renderman.export_inline and \
+        ob.renderman.geometry_source == 'BLENDER_SCENE_DATA' and \
+        is_hashable_geometry(ob, motion, prim)
+
+# Groups objects sharing their data, when no modifier changes it at render
+# time, and returns the group of every object that shares it with another.
+# Objects only share a group when the object settings and vertex group 
+# names their geometry block is written from are the same too.
+def get_shared_data(obs, motion):
+    groups = {}
+    for ob in obs:
+        prim = detect_primitive(ob)
+        if not is_instanceable(ob, motion, prim) or \
+                [m for m in ob.modifiers if m.show_render]:
+            continue
+        key = (ob.data.name, prim, 
+                renderman_signature(ob.renderman, is_geometry_setting), 
+                tuple(group.name for group in ob.vertex_groups))
+        groups.setdefault(key, []).append(ob)
+    
+    shared = {}
+    for key, group in groups.items():
+        if len(group) > 1:
+            for ob in group:
+                shared[ob.name] = key
+    
+    debug("info", "auto instancing: %d objects share %d datablocks" % 
+            (len(shared), len(set(shared.values()))))
+    return shared
+
+# primitive and element counts of the geometry of an object, only 
+# meshes with modifiers and other object types are evaluated to count them
+def geometry_counts(scene, ob, prim):
+    if ob.type != 'MESH' or [m for m in ob.modifiers if m.show_render]:
+        mesh = cached_mesh(scene, ob)
+        counts = (prim, len(mesh.vertices), len(mesh.polygons), 
+                    len(mesh.loops))
+        release_mesh(scene, ob)
+    else:
+        counts = (prim, len(ob.data.vertices), len(ob.data.polygons), 
+                    len(ob.data.loops))
+    return counts
+
+# Groups the given objects by the hash of their geometry, and returns the
+# hash of every object whose geometry is identical to another one's.
+# Only objects whose counts match another's are hashed, and every mesh
+# evaluated here is freed before the next one is.
+def get_shared_geometry(scene, obs, motion):
+    candidates = {}
+    for ob in obs:
+        prim = detect_primitive(ob)
+        if not is_instanceable(ob, motion, prim):
+            continue
+        candidates.setdefault(geometry_counts(scene, ob, prim), 
+                                []).append(ob)
+    
+    groups = {}
+    sizes = {}
+    hashed = 0
+    for counts, candidate_obs in candidates.items():
+        if len(candidate_obs) < 2:
+            continue
+        for ob in candidate_obs:
+            fingerprint, nbytes = geometry_hash(scene, ob, counts[0], 
+                                                keep_mesh=False)
+            groups.setdefault(fingerprint, []).append(ob)
+            sizes[fingerprint] = nbytes
+            hashed += 1
+    
+    shared = {}
+    folded_meshes = 0
+    folded_bytes = 0
+    for fingerprint, group in groups.items():
+        if len(group) < 2:
+            continue
+        for ob in group:
+            shared[ob.name] = fingerprint
+        folded_meshes += len(group) - 1
+        folded_bytes += sizes[fingerprint] * (len(group) - 1)
+    
+    debug("info", "geometry dedup: %d meshes hashed, %d folded into %d "
+            "masters, %d bytes of geometry not written" % (hashed, 
+            folded_meshes, len(set(shared.values())), folded_bytes))
+    return shared
+
 def export_geometry(ri, rpass, scene, ob, motion):
     rm = ob.renderman
     
@@ -1481,7 +2202,8 @@ def export_geometry(ri, rpass, scene, ob, motion):
         #ri.write(geometry_source_rib(scene, ob))
 
 
-def export_object(ri, rpass, scene, ob, motion, mtx = None, dupli_name = None):
+def export_object(ri, rpass, scene, ob, motion, mtx = None, dupli_name = None, 
+                    multi_material = False):
     rm = ob.renderman
 
     if ob.type in ('LAMP', 'CAMERA'): return
@@ -1515,7 +2237,10 @@ def export_object(ri, rpass, scene, ob, motion, mtx = None, dupli_name = None):
     else:
         ri.Transform(rib(mat))
 
-    export_geometry(ri, rpass, scene, ob, motion)
+    if multi_material:
+        export_multi_material_mesh(ri, rpass, scene, ob, motion)
+    else:
+        export_geometry(ri, rpass, scene, ob, motion)
     export_strands(ri, rpass, scene, ob, motion)
     
     ri.AttributeEnd()
@@ -1545,15 +2270,11 @@ def export_motion_ob(scene, motion, ob):
         
         motion['transformation'][ob.name].insert(0, mat.copy())
 
-    # recursive dupli sub-objects
+    # recursive dupli sub-objects, each distinct object once
     if is_dupli(ob):
-        ob.dupli_list_create(scene)
-
-        dupobs = [(dob.object, dob.matrix) for dob in ob.dupli_list]
-        for dupob, dupob_mat in dupobs:
-            if not dupob.hide_render:
+        for dupob in get_duplis(scene, ob)['sources']:
+            if dupob != None and not dupob.hide_render:
                 export_motion_ob(scene, motion, dupob)
-        ob.dupli_list_clear()
 
     # particles
     for psys in ob.particle_systems:
@@ -1566,7 +2287,7 @@ def export_motion_ob(scene, motion, ob):
             motion['deformation'][pname].insert(0, 
                                             get_particles(scene, ob, psys));
         if psys.settings.type == 'HAIR':
-            motion['deformation'][pname].insert(0, get_strands(ri, scene, ob, psys));
+            motion['deformation'][pname].insert(0, get_strands(scene, ob, psys));
 
     if prim in ('POLYGON_MESH', 'SUBDIVISION_MESH', 'POINTS'):
         # fluid sim deformation - special case
@@ -1581,9 +2302,10 @@ def export_motion_ob(scene, motion, ob):
             if ob.name not in motion['deformation'].keys():
                 motion['deformation'][ob.name] = []
             
-            mesh = create_mesh(scene, ob)
-            motion['deformation'][ob.name].insert(0, get_mesh(mesh))
-            bpy.data.meshes.remove(mesh)
+            mesh = cached_mesh(scene, ob, export_mesh_users(scene, ob))
+            motion['deformation'][ob.name].insert(0, 
+                                    get_mesh(mesh, get_mesh_plan(ob)['faces']))
+            release_mesh(scene, ob)
 
     # not working yet, needs access to post-deform-modifier curve data
     elif prim == 'CURVE':
@@ -1609,6 +2331,20 @@ def export_motion(rpass, scene):
     all_segs.append(scene.renderman.motion_segments)
     all_segs = set(all_segs)
     
+    # deforming objects look up whether they are renderable, 
+    # archive exports don't have an index of their own
+    own_index = active_scene_index is None
+    if own_index:
+        begin_scene_index(scene)
+    try:
+        export_motion_segments(scene, motion, origframe, all_segs)
+    finally:
+        if own_index:
+            end_scene_index()
+                        
+    return motion
+
+def export_motion_segments(scene, motion, origframe, all_segs):
     # the aim here is to do only a minimal number of scene updates, 
     # so we process objects in batches of equal numbers of segments
     # and update the scene only once for each of those unique fractional 
@@ -1631,84 +2367,72 @@ def export_motion(rpass, scene):
             
             for ob in motion_obs:
                 export_motion_ob(scene, motion, ob)
-                        
-    return motion
 
 def export_objects(ri, rpass, scene, motion):
-    # Lists that hold names of candidates to consider for export.
-    candidate_datablocks = []
-    candidate_objects = []
-    candidate_multi_material_datablocks = []
-    candidate_multi_material_objects = []
-    candidate_lights = []
+    # Ordered name:type indexes of candidates to consider for export.
+    # Adding a name twice keeps it in its first position, which is the export order.
+    candidate_datablocks = OrderedDict()
+    candidate_objects = OrderedDict()
+    candidate_multi_material_datablocks = OrderedDict()
+    candidate_multi_material_objects = OrderedDict()
+    candidate_lights = OrderedDict()
+    candidate_groups = OrderedDict()
+    # The duplis of each reviewed object, as (name, parent name, dupli cache entry).
     candidate_duplis = []
-    candidate_groups = []
     
-    # Lists that hold names of datablocks that are already exported.
-    exported_datablocks = []
-    exported_objects = []
-    exported_lights = []
-    exported_duplis = []
-    exported_groups = []
-    
-    # List to hold handles for archives and instances.
-    candidate_instance_sources = []
-    candidate_instance_handles = []
-    candidate_archive_handles = []
-    
-    def returnHandleForName(passed_list, passed_name):
-        # Expects list items to contain two entries: name,handle.
-        for name,handle in passed_list:
-            if name == passed_name:
-                return handle
-        return None
+    # Sets that hold names of datablocks that are already exported.
+    exported_datablocks = set()
+    exported_objects = set()
+    exported_lights = set()
+    exported_duplis = set()
+    exported_groups = set()
+    
+    # Indexes from names to the handles of archives and instances.
+    candidate_instance_sources = OrderedDict()
+    candidate_instance_handles = {}
+    candidate_archive_handles = {}
+    
+    # get_object() searches the whole collection, 
+    # every object is only looked up there once.
+    object_index = {}
+    def get_object(ob_name):
+        if ob_name not in object_index:
+            object_index[ob_name] = bpy.data.objects.get(ob_name)
+        return object_index[ob_name]
 
     def reviewObjectForDuplis (scene, ob_name, parent_name, candidate_duplis):
-        ob = bpy.data.objects.get(ob_name)
+        ob = get_object(ob_name)
         if ob:
-            ob.dupli_list_create(scene, 'RENDER')
-            for dob in ob.dupli_list:
-                if dob.object != None:
-                    if dob.hide:
-                        # User has hidden the child object from rendering...
-                        debug ("info","skipping export of [%s], it is hidden from rendering." % dob.object.name)
-                    else:
-                        # NOTE: parent_name is only really needed for particles because multiple systems on the same emitter can be in use.
-                        dupli_name = "%s_%s_p%s" % (ob.name, ("%s~%s" % (parent_name,dob.object.name)), returnNameForNumber(dob.index))
-                        if dob.object.type in SUPPORTED_INSTANCE_TYPES:
-                            # This export object will ginstance the above datablock at the new world location.
-                            candidate_duplis.append((dob.object.name, dob.object.type, dob.matrix.copy(), dupli_name))
-                        elif dob.object.type == 'LAMP':
-                            candidate_duplis.append((dob.object.name, dob.object.type, dob.matrix.copy(), dupli_name))
-                        else:
-                            debug ("warning","unsupported export type of [%s] found in dupli_list." % dob.object.type)
-                else:
-                    debug ("warning","None type object in dupli_list?")
-            ob.dupli_list_clear()
+            # The duplis of an object are kept together, in the arrays of the dupli cache.
+            duplis = get_duplis(scene, ob)
+            debug ("info","[%s] has %d duplis, %d hidden from rendering." % (ob_name, len(duplis['hide']), duplis['hide'].sum()))
+            # NOTE: parent_name is only really needed for particles because multiple systems on the same emitter can be in use.
+            candidate_duplis.append((ob.name, parent_name, duplis))
         else:
             debug ("info","reviewObjectForDuplis: passed object [%s] is not in memory." % ob_name)
 
     # Begin first pass scan of the scene and populate various lists based upon objects discovered.
-    for ob in renderable_objects(scene):
+    scene_index = get_scene_index(scene)
+    for ob in scene_index['renderable']:
         debug ("info","PRMan: Scanning object [%s][%s]" % (ob.name, ob.type))
         if ob.type == 'EMPTY':
             # Support OBJECT and GROUP based duplication for Empties.
             if ob.dupli_type == 'GROUP' and ob.dupli_group != None:
-                candidate_groups.append((ob.dupli_group.name))			# NOTE: The group will take care of exporting any datablocks.
+                candidate_groups[ob.dupli_group.name] = None			# NOTE: The group will take care of exporting any datablocks.
                 reviewObjectForDuplis (scene, ob.name, "", candidate_duplis)
             if ob.dupli_type == 'OBJECT' and ob.dupli_object != None:
-                candidate_instance_sources.append(ob.dupli_object.name)
+                candidate_instance_sources[ob.dupli_object.name] = None
                 reviewObjectForDuplis (scene, ob.name, "", candidate_duplis)
                 
         elif ob.type == 'LAMP':
             # Not supporting dupli-group for lamp type objects at this time.
-            candidate_lights.append((ob.name, ob.type))
+            candidate_lights[ob.name] = ob.type
 
         elif ob.type in SUPPORTED_INSTANCE_TYPES:
-            if ob.parent and ob.parent.dupli_type in SUPPORTED_DUPLI_TYPES:
+            if ob.name in scene_index['dupli_children']:
                 # Skip rendering this object because it a child of a dupli object.
                 # Add it as an instance source, however.
-                candidate_instance_sources.append(ob.name)
+                candidate_instance_sources[ob.name] = None
             else:
                 if ob.dupli_type in SUPPORTED_DUPLI_TYPES:
                     # This object has duplis.
@@ -1722,9 +2446,9 @@ def export_objects(ri, rpass, scene, motion):
                             pset = psys.settings
                             if pset.use_render_emitter:
                                 # User wants to render the emitter as well as the particles.
-                                # In a multiple particle system situation any duplicate emitter objects will be filtered by uniquifyList.
-                                candidate_objects.append((ob.name, ob.type))
-                                candidate_datablocks.append((ob.name, ob.type))
+                                # In a multiple particle system situation any duplicate emitter objects are only indexed once in candidate_objects.
+                                candidate_objects[ob.name] = ob.type
+                                candidate_datablocks[ob.name] = ob.type
                             if pset.render_type == 'OBJECT' and pset.dupli_object != None: contains_duplis = True
                             if pset.render_type == 'GROUP' and pset.dupli_group != None: contains_duplis = True
 
@@ -1813,15 +2537,15 @@ def export_objects(ri, rpass, scene, motion):
                     l = len(ob.data.materials)
                     if l > 1:
                         debug ("info","Adding multi material object and datablock [%s]." % ob.name)
-                        candidate_multi_material_objects.append((ob.name, ob.type))
-                        candidate_multi_material_datablocks.append((ob.name, ob.type))
+                        candidate_multi_material_objects[ob.name] = ob.type
+                        candidate_multi_material_datablocks[ob.name] = ob.type
                     else:
                         debug ("info","Adding single material object and datablock [%s]." % ob.name)
-                        candidate_objects.append((ob.name, ob.type))
-                        candidate_datablocks.append((ob.name, ob.type))
+                        candidate_objects[ob.name] = ob.type
+                        candidate_datablocks[ob.name] = ob.type
 
         elif ob.type == 'CURVE':
-            candidate_objects.append((ob.name, ob.type))
+            candidate_objects[ob.name] = ob.type
         else:
             debug ("warning","Unsupported object type [%s]." % ob.type)
     # End first pass through objects in the scene.
@@ -1834,7 +2558,7 @@ def export_objects(ri, rpass, scene, motion):
     debug ("info","\ncandidate_lights")
     printList(candidate_lights)
     debug ("info","\ncandidate_duplis")
-    debug ("info", len(candidate_duplis))
+    debug ("info", sum(len(duplis['hide']) for ob_name, parent_name, duplis in candidate_duplis))
     #printList(candidate_duplis)
     debug ("info","\ncandidate_groups")
     printList(candidate_groups)
@@ -1863,7 +2587,7 @@ def export_objects(ri, rpass, scene, motion):
     debug ("info","\ncandidate_archive_handles")
     printList(candidate_archive_handles)
 
-    unique_groups = uniquifyList(candidate_groups)
+    unique_groups = list(candidate_groups)
     # Groups can reference objects that are not on renderable layers so review the objects in groups to add to the candidate list.
     for group_name in unique_groups:
         grp = bpy.data.groups.get(group_name)
@@ -1871,9 +2595,9 @@ def export_objects(ri, rpass, scene, motion):
             if len(grp.objects):
                 for grp_ob in grp.objects:
                     if grp_ob.type in SUPPORTED_INSTANCE_TYPES:
-                        candidate_datablocks.append((grp_ob.name, grp_ob.type))
+                        candidate_datablocks[grp_ob.name] = grp_ob.type
                     elif grp_ob.type == 'LAMP':
-                        candidate_lights.append((grp_ob.name, grp_ob.type))
+                        candidate_lights[grp_ob.name] = grp_ob.type
             else:
                 debug ("warning","group [%s] declared but contains no objects." % group_name)
         else:
@@ -1881,20 +2605,34 @@ def export_objects(ri, rpass, scene, motion):
 
     # Export scene lights.
     export_comment(ri, '## LIGHTS')
-    unique_lights = uniquifyList(candidate_lights)
+    unique_lights = list(candidate_lights.items())
     for ob_name, ob_type in unique_lights:
-        ob_temp = bpy.data.objects.get(ob_name)
+        ob_temp = get_object(ob_name)
         if ob_temp != None:
             if ob_type == 'LAMP':
                 export_light(rpass, scene, ri, ob_temp)
-                exported_lights.append(ob_temp.name)
+                exported_lights.add(ob_temp.name)
         
     # Export datablocks for archiving.
     export_comment(ri, '## INLINE ARCHIVES')
-    unique_datablocks = uniquifyList(candidate_datablocks)
+    unique_datablocks = list(candidate_datablocks.items())
     debug ("info","unique_datablocks: %s" % unique_datablocks)
+    
+    # Objects sharing unmodified data, or identical geometry, are written 
+    # once as an instance master. shared_geometry maps their names to the 
+    # key of their master.
+    shared_geometry = {}
+    shared_masters = {}
+    datablock_obs = [get_object(ob_name) for ob_name, ob_type in \
+                        unique_datablocks if get_object(ob_name) != None]
+    if scene.renderman.auto_instancing:
+        shared_geometry.update(get_shared_data(datablock_obs, motion))
+    if scene.renderman.deduplicate_geometry:
+        shared_geometry.update(get_shared_geometry(scene, 
+                [ob for ob in datablock_obs if ob.name not in shared_geometry], 
+                motion))
     for ob_name, ob_type in unique_datablocks:
-        ob_temp = bpy.data.objects.get(ob_name)
+        ob_temp = get_object(ob_name)
         if ob_temp != None:
             if ob_type == 'CURVE' or ob_type == 'FONT':
                 # If this curve is extruded or beveled it can produce faces from a to_mesh call.
@@ -1906,15 +2644,24 @@ def export_objects(ri, rpass, scene, motion):
                     l = 0
             if l > 0:
                 # Check if this archive handle already exists.
-                handle_name = ob_temp.data.name
-                archive_handle = returnHandleForName(candidate_archive_handles,handle_name)
+                # Archives are per object, as modifiers can make objects sharing data differ.
+                handle_name = ob_name
+                archive_handle = candidate_archive_handles.get(ob_name)
                 if archive_handle == None:
                     # No matching handle has been written to the RIB file yet, we are first.
-                    # Export this polymesh data as an archive to be referenced later on.
-                    ri.ArchiveBegin(handle_name)
-                    candidate_archive_handles.append((ob_name, handle_name))
-                    export_geometry(ri, rpass, scene, ob_temp,motion)
-                    ri.ArchiveEnd()
+                    candidate_archive_handles[ob_name] = handle_name
+                    if ob_name in shared_geometry:
+                        # Shared geometry is written once, as a master for all of its objects.
+                        master_key = shared_geometry[ob_name]
+                        if master_key not in shared_masters:
+                            shared_masters[master_key] = ri.ObjectBegin()
+                            export_primitive(ri, scene, ob_temp, motion, detect_primitive(ob_temp))
+                            ri.ObjectEnd()
+                    else:
+                        # Export this polymesh data as an archive to be referenced later on.
+                        ri.ArchiveBegin(handle_name)
+                        export_geometry(ri, rpass, scene, ob_temp,motion)
+                        ri.ArchiveEnd()
                     if ob_temp.particle_systems:
                         debug("info" , "The object has a particle system" , ob_temp)
                         
@@ -1925,7 +2672,7 @@ def export_objects(ri, rpass, scene, motion):
                                 ri.ArchiveBegin(strand_name)
                                 export_strands(ri, rpass, scene, ob_temp, motion)
                                 ri.ArchiveEnd()
-                    exported_datablocks.append(ob_name)
+                    exported_datablocks.add(ob_name)
                 else:
                     debug ("warning","Skipping creating another instance of [%s], it already exists as an Archive in the RIB." % handle_name)
             else:
@@ -1937,11 +2684,11 @@ def export_objects(ri, rpass, scene, motion):
     export_comment(ri, '## OBJECTS')
     debug ("info","candidate_archive_handles: %s" % candidate_archive_handles)
     debug ("info","candidate_objects: %s" % candidate_objects)
-    unique_objects = uniquifyList(candidate_objects)
+    unique_objects = list(candidate_objects.items())
     debug ("info","unique_objects: %s" % unique_objects)
     for ob_name, ob_type in unique_objects:
         debug ("info","fetching [%s]" % ob_name)
-        ob_temp = bpy.data.objects.get(ob_name)
+        ob_temp = get_object(ob_name)
         if ob_temp != None:
             if ob_temp.type in SUPPORTED_INSTANCE_TYPES:
                 if ob_temp.type == 'CURVE' or ob_temp.type == 'FONT':
@@ -1954,16 +2701,19 @@ def export_objects(ri, rpass, scene, motion):
                         l = 0
                 if l > 0:
                     # See if we have already written out this datablock by fetching it's handle.
-                    instance_handle = returnHandleForName(candidate_archive_handles,ob_name)
+                    instance_handle = candidate_archive_handles.get(ob_name)
                     if instance_handle != None:
                         # We have a handle so it is ok to reference this with an object shader/transform.
-                        exportObjectArchive(ri, rpass, scene, ob_temp, returnMatrixForObject(ob_temp), ob_name, instance_handle)
+                        if ob_name in shared_geometry:
+                            exportObjectInstance(ri, rpass, scene, ob_temp, returnMatrixForObject(ob_temp), ob_name, shared_masters[shared_geometry[ob_name]])
+                        else:
+                            exportObjectArchive(ri, rpass, scene, ob_temp, returnMatrixForObject(ob_temp), ob_name, instance_handle)
                         if ob_temp.particle_systems:
                             for psys in ob_temp.particle_systems:
                                 if psys.settings.type == 'HAIR':
                                     hair_handle = instance_handle + "HAIR"
                                     exportObjectArchive(ri, rpass, scene, ob_temp, returnMatrixForObject(ob_temp), ob_name, hair_handle, psys.settings.renderman.material_id - 1)
-                        exported_objects.append(ob_name)
+                        exported_objects.add(ob_name)
                     else:
                         debug ("warning","Could not locate handle for [%s]" % ob_name)
                 else:
@@ -1977,27 +2727,27 @@ def export_objects(ri, rpass, scene, motion):
 
     export_comment(ri, '## INSTANCE MASTERS')
     #Get the object name of every possible particle or dupli source.
-    for ob_name, ob_type, m, dupli_name in candidate_duplis:
-        ob_temp = bpy.data.objects.get(ob_name)
-        if ob_temp != None:
-            candidate_instance_sources.append(ob_name)
+    for ob_name, parent_name, duplis in candidate_duplis:
+        for ob_temp in duplis['sources']:
+            if ob_temp != None and ob_temp.type in SUPPORTED_INSTANCE_TYPES:
+                candidate_instance_sources[ob_temp.name] = None
             
     # This list must be unique for instance handles must be unique within Renderman.		
-    unique_instance_sources = uniquifyList(candidate_instance_sources)
+    unique_instance_sources = list(candidate_instance_sources)
     debug ("info","unique_instance_sources: %s" % unique_instance_sources)
     
     # Create an object instance handle for each object in the instance list.
     for candidate in unique_instance_sources:
-        ob_temp = bpy.data.objects.get(candidate)
+        ob_temp = get_object(candidate)
         if ob_temp != None:
             # Remember, what we are instancing is the datablock, not the object.
             handle_name = ob_temp.data.name
-            instance_handle = returnHandleForName(candidate_instance_handles,handle_name)
+            instance_handle = candidate_instance_handles.get(handle_name)
             if instance_handle == None:
                 result = ri.ObjectBegin()
                 export_geometry(ri, rpass, scene, ob_temp, motion)
                 ri.ObjectEnd()
-                candidate_instance_handles.append((handle_name,result))
+                candidate_instance_handles[handle_name] = result
             else:
                 debug ("warning","handle for [%s] already exists." % candidate)
         else:
@@ -2006,11 +2756,15 @@ def export_objects(ri, rpass, scene, motion):
         
     export_comment(ri, '## INSTANCES') 
     # Export dupli objects as instances. (This list contains objects that are generated from other objects, like duplivert, dupligroup, dupliface, particles)
-    for ob_name, ob_type, m, dupli_name in candidate_duplis:
-        ob_temp = bpy.data.objects.get(ob_name)
-        if ob_temp != None:
-            if ob_type in SUPPORTED_INSTANCE_TYPES:
-                if ob_type == 'CURVE' or ob_type == 'FONT':
+    for ob_name, parent_name, duplis in candidate_duplis:
+        # Look up the instance handle of each source object once, not once per dupli.
+        source_handles = []
+        for ob_temp in duplis['sources']:
+            instance_handle = None
+            if ob_temp == None:
+                debug ("error","None object in dupli export list...?")
+            elif ob_temp.type in SUPPORTED_INSTANCE_TYPES:
+                if ob_temp.type == 'CURVE' or ob_temp.type == 'FONT':
                     # If this curve is extruded or beveled it can produce faces from a to_mesh call.
                     l = ob_temp.data.extrude + ob_temp.data.bevel_depth
                 else:
@@ -2020,97 +2774,44 @@ def export_objects(ri, rpass, scene, motion):
                         l = 0
                 if l > 0:
                     handle_name = ob_temp.data.name
-                    #print("candidate_instance_handles: %s" %candidate_instance_handles)
-                    instance_handle = returnHandleForName(candidate_instance_handles,handle_name)
-                    if instance_handle != None:
-                        exportObjectInstance(ri, rpass, scene, ob_temp, m, dupli_name, instance_handle)
-                        exported_objects.append(dupli_name)
-                    else:
-                        debug ("warning","instance handle for [%s] [%s] not available?" % (ob_name,handle_name))
+                    instance_handle = candidate_instance_handles.get(handle_name)
+                    if instance_handle == None:
+                        debug ("warning","instance handle for [%s] [%s] not available?" % (ob_temp.name,handle_name))
                 else:
-                    debug ("warning","Dupli [%s] has no faces, skipping export?" % ob_name)
-            elif ob_type == 'LAMP':
+                    debug ("warning","Dupli [%s] has no faces, skipping export?" % ob_temp.name)
+            elif ob_temp.type == 'LAMP':
                 #exportLight (ri, scene, ob_temp, m, dupli_name)
-                exported_objects.append(dupli_name)
+                pass
             else:
-                debug ("warning","Unsupported export type [%s] in dupli_list." % ob_type)
-        else:
-            debug ("error","None object in dupli export list...?")
-        ob_temp = None
+                debug ("warning","Unsupported export type [%s] in dupli_list." % ob_temp.type)
+            source_handles.append(instance_handle)
+        
+        # Every transform is converted from the matrix array in one go.
+        matrices = duplis['matrices'].tolist()
+        source = duplis['source'].tolist()
+        index = duplis['index'].tolist()
+        for i in np.flatnonzero(~duplis['hide']).tolist():
+            ob_temp = duplis['sources'][source[i]]
+            if ob_temp == None:
+                continue
+            dupli_name = "%s_%s_p%s" % (ob_name, ("%s~%s" % (parent_name,ob_temp.name)), returnNameForNumber(index[i]))
+            instance_handle = source_handles[source[i]]
+            if instance_handle != None:
+                exportObjectInstance(ri, rpass, scene, ob_temp, matrices[i], dupli_name, instance_handle)
+                exported_objects.add(dupli_name)
+            elif ob_temp.type == 'LAMP':
+                exported_objects.add(dupli_name)
         
     export_comment(ri, '## MULTI-MATERIAL OBJECTS')
-    for ob_candidate_name,ob_candidate_type in candidate_multi_material_objects:
-        ob_temp = bpy.data.objects.get(ob_candidate_name)
+    for ob_candidate_name,ob_candidate_type in candidate_multi_material_objects.items():
+        ob_temp = get_object(ob_candidate_name)
         if ob_temp != None:
             if ob_temp.type == 'MESH':
                 debug ("info","processing multi-material mesh [%s]." % ob_candidate_name)
-                # The mesh with modifiers applied.
-                me_source = ob_temp.to_mesh(scene,True,'RENDER')
-                m = len(me_source.materials)
-                #m = 1 #Atom 07042012 temporary disable.
-                if m > 1:
-                    #Atom 04302012.
-                    #export_comment(ri, 'Atom: Create a mesh for every material applied.\n')
-                
-                    # A list of all the vertices.
-                    list_verts = []
-                    for vertex in me_source.vertices:
-                        list_verts.append(rounded_tuple(vertex.co.to_tuple()))
-
-                    # Fetch the vertex and face list from the provided mesh type object.
-                    list_faces_by_material = []
-                    for face in me_source.polygons:
-                        x = [f for f in face.vertices]
-                        list_faces_by_material.append([face.material_index,x])
-                    c = 0
-                    for mat in me_source.materials:
-                        me_name = "me_" + str(int(c))+ "-PIX_" + ob_candidate_name
-                        me = returnNewMeshFromFaces(me_name,me_source,c)
-                        if me != None:
-                            ob_name = str(int(c))+ "-PIX_" + ob_candidate_name
-                            tempOb = bpy.data.objects.new(ob_name, me)      # Make new object linked to this special mesh.
-                            scene.objects.link(tempOb)                      # Link it to the scene.
-                            try:
-                                tempOb.location = ob_temp.location               # Transfer location to this new object.
-                                tempOb.rotation_euler = ob_temp.rotation_euler   # Transfer rotation to this new object.
-                                tempOb.scale = ob_temp.scale                     # Transfer scale to this new object.
-                            except:
-                                debug ("error","export_objects: error transform mapping for multi-material object.")
-                            try:
-                                tempOb.material_slots[0].material = mat		# Assign this material as the material for the new object.
-                                #print(tempOb.name + " gets material [" + mat.name + "].")
-                            except:
-                                debug ("error","export objects: error assigning material.")
-                            
-                            scene.update()                                  # Required or new object remains at world origin. 
-                            # And while I have your attention, the scene.update() is the cause of slowdown and excessive UI refresh that can occur.
-                            # The only reason for the update is to refresh the transform matrix.
-                            # Because of dupli support we can now override the object matrix with a passed matrix.
-                            # This means if we can come up with a way to contrive/calculated a matrix  we can pass it to export_object and we would not need scene.update().
-                            # (i.e. ToDo)            
-                            # Export this newly generated object.
-                            export_object(ri, rpass, scene, tempOb, motion)
-                            
-                            # Try to remove these temp items from memory.
-                            scene.objects.unlink(tempOb)                    # Remove the object from the scene.
-                            '''
-                            if tempOb.data != None:
-                                l = len(tempOb.data.materials)
-                                if l > 0:
-                                    tempOb.data.materials.pop(l-1)          # Remove the material from the object.
-                            
-                            r = removeObjectFromMemory(ob_name)
-                            if r == False:
-                                print("export_objects: problem removing OBJECT [" + ob_name + "] from memory.")
-                            r = removeMeshFromMemory(me_name)
-                            if r == False:
-                                print("export_objects: problem removing MESH [" + me_name + "] from memory.")
-                            '''
-                        else:
-                            debug ("warning","export_objects: problem creating MESH [" + me_name + "] in memory.")
-                        c = c + 1
+                export_object(ri, rpass, scene, ob_temp, motion, 
+                                multi_material=True)
             else:
-                debug ("error","Unsupported multi-material object type [%s]." % ob.type)
+                debug ("error","Unsupported multi-material object type [%s]." % ob_temp.type)
 
 #TODO take in an ri object and write out archive
 def export_archive(scene, objects, filepath="", archive_motion=True, 
@@ -2379,12 +3080,9 @@ def find_preview_material(scene):
     # taken from mitsuba exporter
     objects_materials = {}
 
-    for object in renderable_objects(scene):
-        for mat in get_instance_materials(object):
-            if mat is not None:
-                if not object.name in objects_materials.keys(): 
-                    objects_materials[object] = []
-                objects_materials[object].append(mat)
+    for mat, obs in get_scene_index(scene)['materials'].items():
+        for object in obs:
+            objects_materials.setdefault(object, []).append(mat)
 
     # find objects that are likely to be the preview objects
     preview_objects = [o for o in objects_materials.keys() \
@@ -2537,6 +3235,12 @@ def write_rib(rpass, scene, ri):
     rpass.motion_blur = None
     rpass.objects = renderable_objects(scene)
     rpass.archives = []
+    rpass.instance_masters = {}
+    rpass.material_archives = {}
+    
+    # meshes and duplis left over from an export that failed
+    clear_mesh_cache()
+    clear_dupli_cache()
 
     motion = export_motion(rpass, scene)
     
@@ -2566,7 +3270,17 @@ def write_rib(rpass, scene, ri):
 
     #default bxdf
     ri.Bxdf("PxrDisney", "default")
-    export_objects(ri, rpass, scene, motion)
+    try:
+        export_material_archives(ri, rpass, scene)
+        export_objects(ri, rpass, scene, motion)
+    finally:
+        # meshes kept for stages that never ran
+        clear_mesh_cache()
+        clear_dupli_cache()
+        report_mesh_timings()
+    
+    if scene.renderman.geometry_cache:
+        prune_geometry_cache(scene, rpass.paths)
     
     ri.WorldEnd()
 
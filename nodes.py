@@ -24,20 +24,21 @@
 # ##### END MIT LICENSE BLOCK #####
 
 import bpy
-import xml.etree.ElementTree as ET
 
 import nodeitems_utils
 from nodeitems_utils import NodeCategory, NodeItem
+from bpy.app.handlers import persistent
 
 from .shader_parameters import class_generate_properties
+from .shader_parameters import get_tex_file_name
 from .shader_parameters import node_add_inputs
 from .shader_parameters import node_add_outputs
 from .util import args_files_in_path
+from .util import get_args_xml
+from .util import save_args_cache
 from .util import get_path_list
-from .util import rib
 
 from operator import attrgetter, itemgetter
-import os.path
 
 NODE_LAYOUT_SPLIT = 0.5
 
@@ -55,6 +56,11 @@ class RendermanPatternGraph(bpy.types.NodeTree):
     bl_icon = 'TEXTURE_SHADED'
     nodetypes = {}
 
+    # node or link edits change the network, drop its compiled program
+    def update(self):
+        shader_programs.pop(self.name, None)
+        record_tree_node_types(self)
+
     @classmethod
     def poll(cls, context):
         return context.scene.render.engine == 'PRMAN_RENDER'
@@ -220,12 +226,90 @@ class RendermanLightNode(RendermanShadingNode):
     renderman_node_type = 'light'
         
 
+# every shader found on the shader paths, registered or not
+# typename: (plugin name, renderman node type, args file)
+node_catalog = {}
+
+def node_type_name(name, nodeType):
+    return '%s%sNode' % (name, nodeType.capitalize())
+
+def catalog_node_types(prefs):
+    node_catalog.clear()
+    for name, arg_file in args_files_in_path(prefs, None).items():
+        nodeType = get_args_xml(arg_file).find("shaderType/tag").attrib['value']
+        node_catalog[node_type_name(name, nodeType)] = \
+            (name, nodeType, arg_file)
+    save_args_cache()
+
+# generate and register a node type from the catalog the first time 
+# it's needed, does nothing for types that already exist.
+# returns whether the type was registered now
+def ensure_node_type(typename):
+    if typename in RendermanPatternGraph.nodetypes or \
+            typename not in node_catalog:
+        return False
+    name, nodeType, arg_file = node_catalog[typename]
+    prefs = bpy.context.user_preferences.addons[__package__].preferences
+    generate_node_type(prefs, name, get_args_xml(arg_file))
+    return True
+
+# register the node types recorded as used by a tree
+def ensure_tree_node_types(nt):
+    node_types = nt.get('renderman_node_types')
+    #saved before node types were recorded, register them all
+    if node_types is None:
+        node_types = ' '.join(node_catalog)
+    registered = [typename for typename in node_types.split() 
+                  if ensure_node_type(typename)]
+    # a program compiled while its nodes were undefined has no links
+    if registered:
+        shader_programs.pop(nt.name, None)
+
+# keep a record of the node types used so they can be registered 
+# when the file is loaded, unless some haven't been registered yet
+def record_tree_node_types(nt):
+    if any(n.bl_idname == 'NodeUndefined' for n in nt.nodes):
+        return
+    node_types = ' '.join(sorted(set(n.bl_idname for n in nt.nodes 
+                                     if n.bl_idname in node_catalog)))
+    if nt.get('renderman_node_types') != node_types:
+        nt['renderman_node_types'] = node_types
+
+# record the node types of trees that were never edited in this session,
+# so files saved before the record existed stop registering every type
+@persistent
+def record_node_types(dummy):
+    for nt in bpy.data.node_groups:
+        if nt.bl_idname == 'RendermanPatternGraph':
+            record_tree_node_types(nt)
+
+# node groups seen by the last check for trees that need node types
+node_group_count = 0
+
+# register the node types used by the trees in a file being loaded.
+# register_class only works from the main thread, so this is never done 
+# from the export, which may run in a render job
+@persistent
+def register_tree_node_types(dummy):
+    global node_group_count
+    node_group_count = len(bpy.data.node_groups)
+    for nt in bpy.data.node_groups:
+        if nt.bl_idname == 'RendermanPatternGraph':
+            ensure_tree_node_types(nt)
+
+# trees appended or linked from another file bring node types of their own,
+# there is no handler for that so look for new node groups after updates
+@persistent
+def register_new_tree_node_types(scene):
+    if len(bpy.data.node_groups) != node_group_count:
+        register_tree_node_types(scene)
+
 # Generate dynamic types
 def generate_node_type(prefs, name, args):
     ''' Dynamically generate a node type from pattern '''
 
     nodeType = args.find("shaderType/tag").attrib['value']
-    typename = '%s%sNode' % (name, nodeType.capitalize())
+    typename = node_type_name(name, nodeType)
     nodeDict = {'bxdf':RendermanBxdfNode, 
                 'pattern': RendermanPatternNode,
                 'displacement': RendermanDisplacementNode,
@@ -410,10 +494,10 @@ class Add_Node:
     '''
     def get_type_items(self, context):
         items = []
-        for nodetype in RendermanPatternGraph.nodetypes.values():
-            if nodetype.renderman_node_type == self.input_type.lower():
-                items.append((nodetype.typename, nodetype.bl_label, 
-                        nodetype.bl_label))
+        #from the catalog, types may not be registered yet
+        for typename,(name,nodeType,arg_file) in node_catalog.items():
+            if nodeType == self.input_type.lower():
+                items.append((typename, name, name))
         items = sorted(items, key=itemgetter(1))
         items.append(('REMOVE', 'Remove', 
                         'Remove the node connected to this socket'))
@@ -445,6 +529,8 @@ class Add_Node:
             nt.links.remove(link)
             return {'FINISHED'}
 
+        ensure_node_type(new_type)
+
         # add a new node to existing socket
         if input_node is None:
             newnode = nt.nodes.new(new_type)
@@ -514,46 +600,92 @@ class NODE_OT_add_pattern(bpy.types.Operator, Add_Node):
     bl_description = 'Connect a Pattern to this socket'
     input_type = bpy.props.StringProperty(default='Pattern')
 
+class NODE_OT_add_renderman_node(bpy.types.Operator):
+    '''
+    Add a node from the add menu, registering its type first 
+    when node types are registered on demand.
+    '''
+
+    bl_idname = 'node.add_renderman_node'
+    bl_label = 'Add RenderMan Node'
+    bl_description = 'Add a RenderMan node'
+    type = bpy.props.StringProperty(name='Node Type')
+
+    def invoke(self, context, event):
+        ensure_node_type(self.type)
+        return bpy.ops.node.add_node('INVOKE_DEFAULT', type=self.type, 
+                                     use_transform=True)
+
 
 #### Rib export
 
-#generate param list
-def gen_params(ri, node):
+# compiled shader networks by node tree name, 
+# (signature, [(node name, {input: (from node name, output)})])
+shader_programs = {}
+
+# every node in a program is linked, so the links also cover renames
+def shader_program_signature(nt):
+    return tuple((l.from_node.name, l.from_socket.identifier, 
+                  l.to_node.name, l.to_socket.identifier) for l in nt.links)
+
+# topologically sort the nodes upstream of the output so that every node
+# comes after the nodes it references and is listed exactly once
+def compile_shader_program(nt, out):
+    program = []
+    visited = set()
+
+    def visit(node):
+        if node.name in visited:
+            return
+        # marked before recursing so a cycle can't loop forever
+        visited.add(node.name)
+        links = {}
+        for prop_name in getattr(node, 'prop_meta', {}):
+            if prop_name in node.inputs and node.inputs[prop_name].is_linked:
+                from_socket = node.inputs[prop_name].links[0].from_socket
+                visit(from_socket.node)
+                links[prop_name] = (from_socket.node.name, 
+                                    from_socket.identifier)
+        program.append((node.name, links))
+
+    for socket in out.inputs:
+        if socket.is_linked:
+            visit(socket.links[0].from_node)
+    return program
+
+def get_shader_program(nt, out):
+    signature = shader_program_signature(nt)
+    cached = shader_programs.get(nt.name)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    program = compile_shader_program(nt, out)
+    shader_programs[nt.name] = (signature, program)
+    return program
+
+# tree names are only unique within a file, and undo restores trees 
+# without calling their update
+@persistent
+def clear_shader_programs(dummy):
+    shader_programs.clear()
+
+#generate param list, links maps linked inputs to their reference
+def gen_params(ri, node, links={}):
     params = {}
-    for prop_name,meta in node.prop_meta.items():
-        prop = getattr(node, prop_name)
-        #if property group recurse
-        if meta['renderman_type'] == 'page':
-            continue
+    #keys and converters are built with the node class
+    for prop_name,key,reference_key,convert in node.prop_emitter:
         #if input socket is linked reference that
-        elif prop_name in node.inputs and node.inputs[prop_name].is_linked:
-            from_socket = node.inputs[prop_name].links[0].from_socket
-            shader_node_rib(ri, from_socket.node)
-            params['reference %s %s' % (meta['renderman_type'], 
-                    meta['renderman_name'])] = \
-                ["%s:%s" % (from_socket.node.bl_idname, from_socket.identifier)]        
-        #else output rib
+        if prop_name in links:
+            params[reference_key] = [links[prop_name]]
         else:
-            if 'options' in meta and meta['options'] == 'texture':
-                params['%s %s' % (meta['renderman_type'], 
-                        meta['renderman_name'])] = \
-                    rib(get_tex_file_name(prop), 
-                        type_hint=meta['renderman_type']) 
-            elif 'arraySize' in meta:
-                params['%s[%d] %s' % (meta['renderman_type'], len(prop), 
-                        meta['renderman_name'])] = rib(prop) 
-            else:
-                params['%s %s' % (meta['renderman_type'], 
-                        meta['renderman_name'])] = \
-                    rib(prop, type_hint=meta['renderman_type']) 
+            params[key] = convert(getattr(node, prop_name))
 
     return params
 
 # Export to rib
-def shader_node_rib(ri, node, handle=None):
-    params = gen_params(ri, node)
+def shader_node_rib(ri, node, handle=None, links={}):
+    params = gen_params(ri, node, links)
     if node.renderman_node_type == "pattern":
-        ri.Pattern(node.bl_label, node.bl_idname, params)
+        ri.Pattern(node.bl_label, handle, params)
     elif node.renderman_node_type == "light":
         #must be off for light sources
         ri.Attribute("visibility", {'int transmission':0, 'int indirect':0})
@@ -562,13 +694,7 @@ def shader_node_rib(ri, node, handle=None):
     elif node.renderman_node_type == "displacement":
         ri.Displacement(node.bl_label, params)
     else:
-        ri.Bxdf(node.bl_label, node.bl_idname, params)
-
-def get_tex_file_name(prop):
-    if prop != '' and prop.rsplit('.', 1) != 'tex':
-        return os.path.basename(prop).rsplit('.', 2)[0] + '.tex'
-    else:
-        return prop
+        ri.Bxdf(node.bl_label, handle, params)
 
 #for an input node output all "nodes"
 def export_shader_nodetree(ri, id, handle=None):
@@ -580,32 +706,48 @@ def export_shader_nodetree(ri, id, handle=None):
 		if not handle:
 			handle = id.name
 
-		out = next((n for n in nt.nodes if n.renderman_node_type == 'output'), 
-                    None)
+		out = next((n for n in nt.nodes 
+                    if getattr(n, 'renderman_node_type', '') == 'output'), None)
 		if out is None: return
 		
 		ri.ArchiveRecord('comment', "Shader Graph")
-		for out_type,socket in out.inputs.items():
-			if socket.is_linked:
-				shader_node_rib(ri, socket.links[0].from_node, handle=handle)
-
-
-def get_textures_for_node(node):
+		# nodes whose type isn't registered are left out, 
+		# along with the links from them
+		undefined = set()
+		# each node once, after everything it references
+		for node_name,links in get_shader_program(nt, out):
+			node = nt.nodes[node_name]
+			if node.bl_idname == 'NodeUndefined':
+				print("RenderMan: skipping node %s of %s, its type is not "
+					"registered" % (node.name, nt.name))
+				ri.ArchiveRecord('comment', "Undefined node %s" % node.name)
+				undefined.add(node_name)
+				continue
+			references = dict((prop_name, "%s:%s" % 
+				(node_shader_handle(nt, nt.nodes[from_name]), output))
+				for prop_name,(from_name,output) in links.items()
+				if from_name not in undefined)
+			if node.renderman_node_type == 'light':
+				node_handle = handle
+			else:
+				node_handle = node_shader_handle(nt, node)
+			shader_node_rib(ri, node, handle=node_handle, links=references)
+
+
+def get_textures_for_node(node, links={}):
     textures = []
     for prop_name,meta in node.prop_meta.items():
-        prop = getattr(node, prop_name)
-        
         if meta['renderman_type'] == 'page':
             continue
         
-        #if input socket is linked reference that
-        elif prop_name in node.inputs and node.inputs[prop_name].is_linked:
-            from_socket = node.inputs[prop_name].links[0].from_socket
-            textures = textures + get_textures_for_node(from_socket.node)
+        #linked inputs are visited as nodes of their own
+        elif prop_name in links:
+            continue
         
         #else return a tuple of in name/outname
         else:
             if 'options' in meta and meta['options'] == 'texture':# and prop != "" and prop.rsplit('.', 1) != 'tex':
+                prop = getattr(node, prop_name)
                 textures.append((prop, get_tex_file_name(prop)))
 
     return textures
@@ -620,18 +762,27 @@ def get_textures(id):
         nt = None
 
     if nt:
-        out = next((n for n in nt.nodes if n.renderman_node_type == 'output'), 
-                    None)
+        out = next((n for n in nt.nodes 
+                    if getattr(n, 'renderman_node_type', '') == 'output'), None)
         if out is None: return
         
-        for name,inp in out.inputs.items():
-            if inp.is_linked:
-                textures = textures + \
-                    get_textures_for_node(inp.links[0].from_node)
+        for node_name,links in get_shader_program(nt, out):
+            node = nt.nodes[node_name]
+            # reported when the tree is exported
+            if node.bl_idname == 'NodeUndefined':
+                continue
+            textures = textures + get_textures_for_node(node, links)
         
     return textures
 
 
+# add menu entry that only registers its node type when used
+class RendermanNodeItem(NodeItem):
+    @staticmethod
+    def draw(self, layout, context):
+        props = layout.operator("node.add_renderman_node", text=self.label)
+        props.type = self.nodetype
+
 # our own base class with an appropriate poll function,
 # so the categories only show up in our own tree type
 class RendermanPatternNodeCategory(NodeCategory):
@@ -657,19 +808,31 @@ def register():
     #def load_handler(dummy):
     categories = {}
 
-    for name, arg_file in args_files_in_path(prefs, None).items():
-        generate_node_type(prefs, name, ET.parse(arg_file).getroot())
+    bpy.app.handlers.load_post.append(clear_shader_programs)
+    bpy.app.handlers.undo_post.append(clear_shader_programs)
+    bpy.app.handlers.save_pre.append(record_node_types)
+
+    catalog_node_types(prefs)
+    if prefs.lazy_node_types:
+        node_item_type = RendermanNodeItem
+        bpy.app.handlers.load_post.append(register_tree_node_types)
+        bpy.app.handlers.scene_update_post.append(
+            register_new_tree_node_types)
+    else:
+        node_item_type = NodeItem
+        for typename in node_catalog:
+            ensure_node_type(typename)
 
     pattern_nodeitems = []
     bxdf_nodeitems = []
     light_nodeitems = []
-    for name, node_type in RendermanPatternGraph.nodetypes.items():
-        node_item = NodeItem(name, label=node_type.bl_label)
-        if node_type.renderman_node_type == 'pattern':
+    for typename, (name, nodeType, arg_file) in node_catalog.items():
+        node_item = node_item_type(typename, label=name)
+        if nodeType == 'pattern':
             pattern_nodeitems.append(node_item)
-        elif node_type.renderman_node_type == 'bxdf':
+        elif nodeType == 'bxdf':
             bxdf_nodeitems.append(node_item)
-        elif node_type.renderman_node_type == 'light':
+        elif nodeType == 'light':
             light_nodeitems.append(node_item)
        
 
@@ -695,4 +858,15 @@ def register():
 
 def unregister():
     nodeitems_utils.unregister_node_categories("RENDERMANSHADERNODES")
+    if clear_shader_programs in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.remove(clear_shader_programs)
+    if clear_shader_programs in bpy.app.handlers.undo_post:
+        bpy.app.handlers.undo_post.remove(clear_shader_programs)
+    if register_tree_node_types in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.remove(register_tree_node_types)
+    if register_new_tree_node_types in bpy.app.handlers.scene_update_post:
+        bpy.app.handlers.scene_update_post.remove(
+            register_new_tree_node_types)
+    if record_node_types in bpy.app.handlers.save_pre:
+        bpy.app.handlers.save_pre.remove(record_node_types)
     #bpy.utils.unregister_module(__name__)
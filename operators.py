@@ -32,6 +32,7 @@ IntProperty, FloatProperty, FloatVectorProperty, CollectionProperty
 
 from .util import init_env
 from .util import getattr_recursive
+from .util import refresh_shader_catalog
 
 
 from .shader_parameters import tex_source_path
@@ -39,6 +40,7 @@ from .shader_parameters import tex_optimised_path
 
 from .export import make_optimised_texture_3dl
 from .export import export_archive
+from .nodes import ensure_node_type
 
 from bpy_extras.io_utils import ExportHelper
 
@@ -62,6 +64,7 @@ class SHADING_OT_add_renderman_nodetree(bpy.types.Operator):
 
         if idtype == 'material':
             output = nt.nodes.new('RendermanOutputNode')
+            ensure_node_type('PxrDisneyBxdfNode')
             default = nt.nodes.new('PxrDisneyBxdfNode')
             default.location = output.location
             default.location[0] -= 300
@@ -76,6 +79,7 @@ class SHADING_OT_add_renderman_nodetree(bpy.types.Operator):
                 light_shader = 'PxrStdEnvMapLightLightNode'
 
             output = nt.nodes.new('RendermanOutputNode')
+            ensure_node_type(light_shader)
             default = nt.nodes.new(light_shader)
             default.location = output.location
             default.location[0] -= 300
@@ -88,6 +92,18 @@ class SHADING_OT_add_renderman_nodetree(bpy.types.Operator):
         return {'FINISHED'}
 
 
+class SHADING_OT_refresh_shader_catalog(bpy.types.Operator):
+    ''''''
+    bl_idname = "shading.refresh_shader_catalog"
+    bl_label = "Refresh Shader List"
+    bl_description = "List the shader paths again for new or removed shaders"
+
+    def execute(self, context):
+        prefs = context.user_preferences.addons[__package__].preferences
+        refresh_shader_catalog(prefs, relist=True)
+        return {'FINISHED'}
+
+
 class ExportRIBArchive(bpy.types.Operator, ExportHelper):
     ''''''
     bl_idname = "export_shape.rib"
@@ -100,6 +100,10 @@ class RendermanPreferences(AddonPreferences):
         name="Use built in paths",
         description="Includes paths for default shaders etc. from PRMan exporter",
         default=False)
+    lazy_node_types = BoolProperty(
+        name="Register shader nodes on demand",
+        description="Only create node types for shaders when they are added or found in a loaded file. Takes effect when the add-on is next enabled",
+        default=False)
 
     path_rmantree = StringProperty(
         name="RMANTREE Path",
@@ -137,6 +141,7 @@ class RendermanPreferences(AddonPreferences):
 
         layout.prop(self, "use_default_paths")
         layout.prop(self, "use_builtin_paths")
+        layout.prop(self, "lazy_node_types")
         '''
         self._draw_collection(context, layout, self, "Shader Paths:", "collection.add_remove",
                                         "scene", "shader_paths", "shader_paths_index")
@@ -25,12 +25,14 @@
 
 import bpy
 import os
-import xml.etree.ElementTree as ET
 #from .properties_shader import RendermanCoshader, coshaderShaders
 
 from .util import guess_rmantree
 
-from .util import args_files_in_path
+from .util import get_shader_catalog
+from .util import get_args_xml
+from .util import save_args_cache
+from .nodes import ensure_node_type
 
 #from .shader_parameters import rna_type_initialise
 
@@ -43,8 +45,9 @@ CollectionProperty
 
 def shader_list_items(self, context, shader_type):
     defaults = [('null', 'None', ''), ('custom', 'Custom', '')]
-    return defaults + [ (s, s, '') for s in args_files_in_path(context.scene, 
-        context.material, shader_type=shader_type)]
+    prefs = context.user_preferences.addons[__package__].preferences
+    return defaults + [ (s, s, '') for s in 
+        sorted(get_shader_catalog(prefs))]
     
 def shader_list_update(self, context, shader_type):
     # don't overwrite active when set to custom
@@ -92,7 +95,7 @@ def register_integrator_settings(scene_settings_cls):
         ntype.bl_label = name
         ntype.typename = typename
         #do some parsing and get props
-        args_xml = ET.parse(os.path.join(args_path, f)).getroot()
+        args_xml = get_args_xml(os.path.join(args_path, f))
         for p in args_xml.findall('./param'):
             param_name = p.attrib['name']
             param_label = param_name
@@ -188,6 +191,7 @@ def register_integrator_settings(scene_settings_cls):
             PointerProperty(type=ntype, name="%s Settings" % name)
             )
         #items.append(PointerProperty(type=ntype, name="%s Settings" % name))
+    save_args_cache()
 
     #return items
 
@@ -517,6 +521,22 @@ class RendermanSceneSettings(bpy.types.PropertyGroup):
                     ('EXPORT', 'Export RIB Only', 'Generate RIB file only')],
                 default='EXPORT_RENDER')
 
+    geometry_cache = BoolProperty(
+                name="Cache Geometry Archives",
+                description="Write the geometry of each object to an archive in the export folder named after a hash of its data, and reuse it on later renders while nothing changed",
+                default=False)
+    geometry_cache_max_age = IntProperty(
+                name="Cache Max Age",
+                description="Remove cached geometry archives that no render has used for this many days",
+                min=1, default=7)
+    auto_instancing = BoolProperty(
+                name="Auto Instancing",
+                description="Export objects sharing mesh data without render modifiers as instances of a single shared master",
+                default=True)
+    deduplicate_geometry = BoolProperty(
+                name="Deduplicate Geometry",
+                description="Export objects with identical geometry as instances of a single shared master",
+                default=False)
     always_generate_textures = BoolProperty(
                 name="Always Recompile Textures",
                 description="Recompile used textures at export time to the current rib folder. Leave this unchecked to speed up re-render times",
@@ -977,6 +997,7 @@ class RendermanLightSettings(bpy.types.PropertyGroup):
                 nt.links.new(node.outputs[0], output.inputs['Light'])
                 break
         else:
+            ensure_node_type(light_shader)
             light = nt.nodes.new(light_shader)
             light.location = output.location
             light.location[0] -= 300
@@ -1162,6 +1183,37 @@ class RendermanParticleSettings(bpy.types.PropertyGroup):
                 precision=4,
                 default=0.00)
 
+    strand_batches = IntProperty(
+                name="Strand Batches",
+                description="Number of Curves calls the strands of a hair system are split into",
+                min=1, default=1)
+
+    hair_chunking = EnumProperty(
+                name="Hair Chunking",
+                description="Split the hair system into spatial chunks so the renderer only loads the visible part",
+                items=[('NONE', 'None', 'Export the hair system as a single block'),
+                        ('INLINE', 'Inline', 'Export each chunk inline with its own bound'),
+                        ('DELAYED', 'Delayed Read Archive', 'Export each chunk as an archive loaded only when its bound is visible')],
+                default='NONE')
+
+    hair_chunk_grid = IntProperty(
+                name="Chunk Grid",
+                description="Number of grid cells per axis over the hair root positions",
+                min=1, max=64, default=4)
+
+    points_chunking = EnumProperty(
+                name="Points Chunking",
+                description="Split the particle points into spatially coherent chunks so the renderer only loads the visible part",
+                items=[('NONE', 'None', 'Export the particle system in a single Points call'),
+                        ('INLINE', 'Inline', 'Export each chunk inline with its own bound'),
+                        ('DELAYED', 'Delayed Read Archive', 'Export each chunk as an archive loaded only when its bound is visible')],
+                default='NONE')
+
+    points_chunk_size = IntProperty(
+                name="Points Per Chunk",
+                description="Maximum number of particles written in each chunk",
+                min=1, default=100000)
+
     export_default_size = BoolProperty(
                 name="Export Default size",
                 description="Export the particle size as the default 'width' primitive variable",
@@ -1282,6 +1334,11 @@ class RendermanObjectSettings(bpy.types.PropertyGroup):
                         ],
                 default='AUTO')
 
+    export_inline = BoolProperty(
+                name="Export Inline",
+                description="Always export the geometry of this object on its own, even when it could be instanced from geometry shared with other objects",
+                default=False)
+
     export_archive = BoolProperty(
                 name="Export as Archive",
                 description="At render export time, store this object as a RIB archive",
@@ -88,6 +88,12 @@ def get_texture_optpath(name, frame):
     except KeyError:
         return ""
 
+def get_tex_file_name(prop):
+    if prop != '' and prop.rsplit('.', 1) != 'tex':
+        return os.path.basename(prop).rsplit('.', 2)[0] + '.tex'
+    else:
+        return prop
+
 
 def sp_optionmenu_to_string(options):
     return [(opt.attrib['value'], opt.attrib['name'], 
@@ -119,9 +125,43 @@ def parse_float(fs):
     return float(fs[:-1]) if 'f' in fs else float(fs)
 
 
+def rib_texture_param(prop):
+    return get_tex_file_name(prop)
+
+def rib_value_param(prop):
+    return prop
+
+# converter from a property value to its Ri parameter value
+def param_converter(meta):
+    if 'options' in meta and meta['options'] == 'texture':
+        return rib_texture_param
+    elif 'arraySize' in meta:
+        return list
+    elif meta['renderman_type'] == 'float':
+        return float
+    elif meta['renderman_type'] == 'int':
+        return int
+    elif meta['renderman_type'] in ('color', 'vector', 'normal'):
+        return list
+    else:
+        return rib_value_param
+
+# the Ri parameter names and converter for a property, worked out once 
+# per node class so exporting a node doesn't rebuild them
+def param_emitter(name, meta):
+    if 'arraySize' in meta:
+        key = '%s[%d] %s' % (meta['renderman_type'], 
+                int(meta['arraySize']), meta['renderman_name'])
+    else:
+        key = '%s %s' % (meta['renderman_type'], meta['renderman_name'])
+    reference_key = 'reference %s %s' % (meta['renderman_type'], 
+                        meta['renderman_name'])
+    return (name, key, reference_key, param_converter(meta))
+
 def class_generate_properties(node, parent_name, shaderparameters):
     prop_names = []
     prop_meta = {}
+    prop_emitter = []
 
     for sp in shaderparameters:
         if sp.tag == 'page':
@@ -135,6 +175,7 @@ def class_generate_properties(node, parent_name, shaderparameters):
                     name = name + '_prop'
                 sub_params.append(name)
                 prop_meta[name] = meta
+                prop_emitter.append(param_emitter(name, meta))
                 setattr(node, name, prop)
             prop_names.append(sp.attrib['name'])
             prop_meta[sp.attrib['name']] = {'renderman_type':'page'}
@@ -143,10 +184,12 @@ def class_generate_properties(node, parent_name, shaderparameters):
             name,meta,prop = generate_property(sp)
             prop_names.append(name)
             prop_meta[name] = meta
+            prop_emitter.append(param_emitter(name, meta))
             setattr(node, name, prop)
 
     setattr(node, 'prop_names', prop_names)
     setattr(node, 'prop_meta', prop_meta)
+    setattr(node, 'prop_emitter', tuple(prop_emitter))
 
 #map args params to props
 def generate_property(sp):
@@ -192,6 +235,7 @@ def generate_property(sp):
                         default=param_default, precision=3,
                         size=len(param_default),
                         description=param_help)
+            prop_meta['arraySize'] = len(param_default)
 
         else:
             param_default = parse_float(param_default)
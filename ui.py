@@ -176,13 +176,18 @@ class ShaderPanel():
 
     def _draw_shader_menu_params(self, layout, context, ptr):
         if not self.found_shaders(context, ptr):
-            layout.label("Loading Shaders...")
+            row = layout.row()
+            row.label("Loading Shaders...")
+            row.operator("shading.refresh_shader_catalog", text="", 
+                         icon='FILE_REFRESH')
             return
 
         row = layout.row()
         shaders = getattr(ptr, "%s_shaders" % self.shader_type)
         
         row.prop(shaders, "shader_list", text="")
+        row.operator("shading.refresh_shader_catalog", text="", 
+                     icon='FILE_REFRESH')
         
         if shaders.shader_list == "custom":
             row.prop(shaders, "active", text="")
@@ -453,6 +458,11 @@ class RENDER_PT_renderman_output(PRManButtonsPanel, Panel):
         if rm.display_driver not in ('it', 'blender'):
             layout.prop(rm, "path_display_driver_image")
         layout.prop(rm, "always_generate_textures")
+        layout.prop(rm, "geometry_cache")
+        if rm.geometry_cache:
+            layout.prop(rm, "geometry_cache_max_age")
+        layout.prop(rm, "auto_instancing")
+        layout.prop(rm, "deduplicate_geometry")
         layout.prop(rm, "threads")
         if rm.display_driver == 'blender':
             layout.prop(rm, "update_frequency")
@@ -1461,6 +1471,7 @@ class OBJECT_PT_renderman_object_geometry(Panel):
                 colf.prop(rm, "primitive_point_type")
                 colf.prop(rm, "primitive_point_width")
                     
+            col.prop(rm, "export_inline")
             col.prop(rm, "export_archive")
             #if rm.export_archive:                
             #    col.prop(rm, "export_archive_path")
@@ -1636,6 +1647,19 @@ class PARTICLE_PT_renderman_particle(ParticleButtonsPanel, Panel):
         subcol2.prop(rm, "tip_width")
         #subcol2.prop(rm, "width_offset")
 
+        if psys.settings.type == 'HAIR':
+            col = layout.column()
+            col.prop(rm, "hair_chunking")
+            if rm.hair_chunking == 'NONE':
+                col.prop(rm, "strand_batches")
+            else:
+                col.prop(rm, "hair_chunk_grid")
+        elif rm.particle_type != 'OBJECT':
+            col = layout.column()
+            col.prop(rm, "points_chunking")
+            if rm.points_chunking != 'NONE':
+                col.prop(rm, "points_chunk_size")
+
 
 class PARTICLE_PT_renderman_prim_vars(CollectionPanel, Panel):
     bl_context = "particle"
@@ -30,6 +30,11 @@ import os
 import platform
 import sys
 import fnmatch
+import json
+import threading
+import time
+import numpy as np
+import xml.etree.ElementTree as ET
 from extensions_framework import util as efutil
 from mathutils import Matrix, Vector
 EnableDebugging = False
@@ -94,12 +99,161 @@ def args_files_in_path(prefs, idblock, shader_type='', threaded=True):
 
     path_list = get_path_list_converted(prefs, 'shader')
     for path in path_list:
-        for root, dirnames, filenames in os.walk(path):
-            for filename in fnmatch.filter(filenames, '*.args'):
-                args[filename.split('.')[0]] = os.path.join(root, filename)
+        args.update(walk_args_files(path))
+
+    # a full listing is as good as a catalog refresh
+    shader_catalog['shaders'] = args
+    shader_catalog['time'] = time.time()
     
     return args
 
+# -------------------- Args Schema Cache -----------------------
+
+# parsed args files and shader directory listings are kept between sessions,
+# keyed by path with mtime (and size for files) so that only what changed on
+# disk is listed or parsed again.
+# bump the version whenever the layout of the cache file changes
+args_cache_version = 1
+args_cache = None
+args_cache_file = None
+args_cache_dirty = False
+# the shader catalog updates the cache from a background thread
+args_cache_lock = threading.Lock()
+
+def args_cache_path():
+    return os.path.join(bpy.utils.user_resource('CONFIG', path='renderman', 
+                        create=True), 'args_cache.json')
+
+def get_args_cache():
+    global args_cache, args_cache_file
+    if args_cache is None:
+        args_cache_file = args_cache_path()
+        try:
+            with open(args_cache_file) as f:
+                args_cache = json.load(f)
+            if args_cache['version'] != args_cache_version:
+                raise ValueError('args cache version %s' % 
+                                 args_cache['version'])
+        except:
+            args_cache = {'version': args_cache_version, 'dirs': {}, 
+                          'files': {}}
+    return args_cache
+
+def save_args_cache():
+    global args_cache_dirty
+    if not args_cache_dirty:
+        return
+    path = args_cache_file
+    try:
+        with args_cache_lock:
+            with open(path + '.tmp', 'w') as f:
+                json.dump(args_cache, f)
+            os.replace(path + '.tmp', path)
+            args_cache_dirty = False
+    except:
+        debug('warning', 'could not write args cache', path)
+
+# walk a shader path like os.walk, listing a directory again only 
+# when its mtime changed, or always with relist
+def walk_args_files(path, relist=False):
+    global args_cache_dirty
+    dirs = get_args_cache()['dirs']
+    args = {}
+    stack = [path]
+    while stack:
+        root = stack.pop()
+        try:
+            mtime = os.stat(root).st_mtime
+        except OSError:
+            continue
+        entry = dirs.get(root)
+        if relist or entry is None or entry[0] != mtime:
+            try:
+                names = os.listdir(root)
+            except OSError:
+                continue
+            dirnames = []
+            filenames = []
+            for name in names:
+                full_path = os.path.join(root, name)
+                if os.path.isdir(full_path):
+                    if not os.path.islink(full_path):
+                        dirnames.append(name)
+                elif fnmatch.fnmatch(name, '*.args'):
+                    filenames.append(name)
+            entry = [mtime, dirnames, filenames]
+            with args_cache_lock:
+                dirs[root] = entry
+                args_cache_dirty = True
+
+        for filename in entry[2]:
+            args[filename.split('.')[0]] = os.path.join(root, filename)
+        stack.extend(os.path.join(root, d) for d in reversed(entry[1]))
+
+    return args
+
+def args_element_to_data(element):
+    return [element.tag, dict(element.attrib), element.text, 
+            [args_element_to_data(child) for child in element]]
+
+def args_data_to_element(data):
+    tag, attrib, text, children = data
+    element = ET.Element(tag, attrib)
+    element.text = text
+    element.extend(args_data_to_element(child) for child in children)
+    return element
+
+# the root element of an args file, rebuilt from the cache unless 
+# the file changed since it was parsed
+def get_args_xml(path):
+    global args_cache_dirty
+    files = get_args_cache()['files']
+    stat = os.stat(path)
+    entry = files.get(path)
+    if entry is None or entry[0] != stat.st_mtime or \
+            entry[1] != stat.st_size:
+        root = ET.parse(path).getroot()
+        entry = [stat.st_mtime, stat.st_size, args_element_to_data(root)]
+        with args_cache_lock:
+            files[path] = entry
+            args_cache_dirty = True
+    # always a fresh tree, node generation writes into the attributes
+    return args_data_to_element(entry[2])
+
+# -------------------- Shader Catalog -----------------------
+
+# names and args files of the shaders on the shader paths, for UI callbacks
+# which only ever read what the last refresh found. refreshes list the 
+# shader paths on a background thread, through the directory mtime cache
+shader_catalog = {'shaders': {}, 'time': 0.0}
+shader_catalog_thread = None
+# seconds before reading the catalog starts a refresh to pick up changes
+shader_catalog_interval = 10.0
+
+def refresh_shader_catalog(prefs, relist=False):
+    global shader_catalog_thread
+    if shader_catalog_thread is not None and shader_catalog_thread.is_alive():
+        return
+    # paths are resolved here, blender data can't be read from the thread
+    path_list = get_path_list_converted(prefs, 'shader')
+    shader_catalog['time'] = time.time()
+    shader_catalog_thread = threading.Thread(target=update_shader_catalog, 
+                                             args=(path_list, relist))
+    shader_catalog_thread.daemon = True
+    shader_catalog_thread.start()
+
+def update_shader_catalog(path_list, relist):
+    shaders = {}
+    for path in path_list:
+        shaders.update(walk_args_files(path, relist))
+    shader_catalog['shaders'] = shaders
+    save_args_cache()
+
+def get_shader_catalog(prefs):
+    if time.time() - shader_catalog['time'] > shader_catalog_interval:
+        refresh_shader_catalog(prefs)
+    return shader_catalog['shaders']
+
 def get_path_list(rm, type):
     paths = []
     if rm.use_default_paths:
@@ -239,8 +393,12 @@ def user_path(path, scene=None, ob=None):
 
 def rib(v, type_hint=None):
 
+    # flat arrays filled by foreach_get
+    if type(v) == np.ndarray:
+        return v.tolist()
+
     # float, int
-    if type(v) in (mathutils.Vector, mathutils.Color) or v.__class__.__name__ == 'bpy_prop_array'\
+    elif type(v) in (mathutils.Vector, mathutils.Color) or v.__class__.__name__ == 'bpy_prop_array'\
         or v.__class__.__name__ == 'Euler': 
         # BBM modified from if to elif
         return list(v)
@@ -265,6 +423,10 @@ def rib(v, type_hint=None):
 
     
 
+# convert every value of an Ri parameter list
+def rib_params(params):
+    return dict((key, rib(value)) for key, value in params.items())
+
 def rib_ob_bounds(ob_bb):
     return ( ob_bb[0][0], ob_bb[7][0], ob_bb[0][1],
             ob_bb[7][1], ob_bb[0][2], ob_bb[7][2] )